@@ -1,13 +1,23 @@
-from .entry import ArchiveEntry
+from .entry import ArchiveEntry, EntryInfo
 from .exception import ArchiveError
-from .extract import extract_fd, extract_file, extract_memory
-from .read import custom_reader, fd_reader, file_reader, memory_reader
-from .write import custom_writer, fd_writer, file_writer, memory_writer
+from .extract import (
+    extract_fd, extract_file, extract_many, extract_memory, extract_to_memory
+)
+from .read import (
+    custom_reader, fd_reader, file_reader, list_entries, memory_reader,
+    mmap_reader,
+)
+from .write import (
+    custom_writer, fd_writer, file_writer, memory_writer,
+    parallel_file_writer, parallel_writer, stream_archive,
+)
 
 __all__ = [
-    ArchiveEntry,
+    ArchiveEntry, EntryInfo,
     ArchiveError,
-    extract_fd, extract_file, extract_memory,
-    custom_reader, fd_reader, file_reader, memory_reader,
-    custom_writer, fd_writer, file_writer, memory_writer
+    extract_fd, extract_file, extract_many, extract_memory, extract_to_memory,
+    custom_reader, fd_reader, file_reader, list_entries, memory_reader,
+    mmap_reader,
+    custom_writer, fd_writer, file_writer, memory_writer,
+    parallel_file_writer, parallel_writer, stream_archive,
 ]
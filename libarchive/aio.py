@@ -0,0 +1,323 @@
+"""asyncio front-ends to the readers and writers.
+
+libarchive is blocking, so each archive gets its own thread in which all the
+calls to libarchive are made, while the event loop stays free. Data streamed
+from or to coroutines crosses between the two through bounded queues.
+
+This module requires Python 3.7 or later.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+import sys
+
+from . import read, write
+from .ffi import ARCHIVE_FATAL, page_size
+
+
+DEFAULT_QUEUE_SIZE = 16
+
+
+class ArchiveThread(object):
+    """ a dedicated thread in which the calls to libarchive are made """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(1)
+
+    async def run(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.executor, partial(func, *args, **kwargs)
+        )
+
+    def call_coroutine(self, coro):
+        """ run a coroutine on the event loop and wait for its result
+
+            Only to be called from the archive thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def enter(self, context_manager):
+        """ enter a synchronous context manager in the thread """
+        self.context_manager = context_manager
+        return await self.run(context_manager.__enter__)
+
+    async def exit(self, exc_info=(None, None, None)):
+        try:
+            await self.run(self.context_manager.__exit__, *exc_info)
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+@asynccontextmanager
+async def _open(context_manager_factory, wrapper_class, *args, **kwargs):
+    thread = kwargs.pop('thread', None) or ArchiveThread()
+    errors = kwargs.pop('errors', None)
+    try:
+        archive = await thread.enter(
+            await thread.run(context_manager_factory, *args, **kwargs)
+        )
+    except BaseException:
+        thread.executor.shutdown(wait=False)
+        if errors:
+            raise errors[0]
+        raise
+    try:
+        yield wrapper_class(archive, thread, errors)
+    except BaseException:
+        await thread.exit(sys.exc_info())
+        raise
+    await thread.exit()
+
+
+class AsyncArchiveEntry(object):
+    """ an entry of an archive being read asynchronously
+
+        The attributes of the entry's `EntryInfo` snapshot are available
+        directly. The data is read in the archive's thread, and only until
+        the next entry is requested.
+    """
+
+    def __init__(self, entry, info, thread):
+        self._entry = entry
+        self.info = info
+        self._thread = thread
+
+    def __getattr__(self, name):
+        return getattr(self.info, name)
+
+    def __str__(self):
+        return str(self.info)
+
+    async def read(self, n=-1):
+        """ read and return up to `n` bytes of data, or all of it """
+        if n is None or n < 0:
+            return await self._thread.run(self._read_all)
+        return await self._thread.run(self._read, n)
+
+    def _read_all(self):
+        return b''.join(self._entry.get_blocks())
+
+    def _read(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            length = self._entry.readinto(view[pos:])
+            if not length:
+                break
+            pos += length
+        del view
+        del buf[pos:]
+        return bytes(buf)
+
+    async def readinto(self, buffer):
+        """ read data into a writable buffer, return the number of bytes """
+        return await self._thread.run(self._entry.readinto, buffer)
+
+    async def get_blocks(self, block_size=None):
+        """ asynchronously iterate over the blocks of data """
+        if block_size is None:
+            block_size = page_size
+        while 1:
+            block = await self._thread.run(self._read, block_size)
+            if not block:
+                break
+            yield block
+
+
+class AsyncArchiveRead(object):
+
+    def __init__(self, archive, thread, errors=None):
+        self._archive = archive
+        self._thread = thread
+        self._entries = None
+        # errors raised by the coroutines feeding the archive
+        self._errors = errors
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            entry = await self._thread.run(self._next_entry)
+        except Exception:
+            if self._errors:
+                raise self._errors[0]
+            raise
+        if self._errors:
+            raise self._errors[0]
+        if entry is None:
+            raise StopAsyncIteration
+        return entry
+
+    def _next_entry(self):
+        if self._entries is None:
+            self._entries = iter(self._archive)
+        entry = next(self._entries, None)
+        if entry is None:
+            return None
+        return AsyncArchiveEntry(entry, entry.snapshot(), self._thread)
+
+
+class AsyncArchiveWrite(object):
+
+    def __init__(self, archive, thread, errors=None):
+        self._archive = archive
+        self._thread = thread
+        # errors raised by the coroutines consuming the archive
+        self._errors = errors
+
+    async def _run(self, func, *args, **kwargs):
+        try:
+            return await self._thread.run(func, *args, **kwargs)
+        except Exception:
+            if self._errors:
+                raise self._errors[0]
+            raise
+
+    async def add_entries(self, entries):
+        """Add the given entries to the archive, see `ArchiveWrite`."""
+        await self._run(self._archive.add_entries, entries)
+
+    async def add_files(self, *paths, **kwargs):
+        """Add files from the disk to the archive, see `ArchiveWrite`."""
+        await self._run(self._archive.add_files, *paths, **kwargs)
+
+    async def add_file_from_memory(self, *args, **kwargs):
+        """Add a file from memory to the archive, see `ArchiveWrite`."""
+        await self._run(self._archive.add_file_from_memory, *args, **kwargs)
+
+
+def fd_reader(*args, **kwargs):
+    """Asynchronous version of `libarchive.read.fd_reader`."""
+    return _open(read.fd_reader, AsyncArchiveRead, *args, **kwargs)
+
+
+def file_reader(*args, **kwargs):
+    """Asynchronous version of `libarchive.read.file_reader`."""
+    return _open(read.file_reader, AsyncArchiveRead, *args, **kwargs)
+
+
+def memory_reader(*args, **kwargs):
+    """Asynchronous version of `libarchive.read.memory_reader`."""
+    return _open(read.memory_reader, AsyncArchiveRead, *args, **kwargs)
+
+
+@asynccontextmanager
+async def stream_reader(read_func, format_name='all', filter_name='all',
+                        block_size=page_size, queue_size=DEFAULT_QUEUE_SIZE,
+                        **kwargs):
+    """Read an archive from a coroutine function.
+
+    `read_func(n)` returns up to `n` bytes, and an empty bytes object at the
+    end, like `asyncio.StreamReader.read`. Up to `queue_size` blocks are read
+    ahead while libarchive decompresses the previous ones.
+
+    Extra keyword arguments are passed to `custom_reader`.
+    """
+    queue = asyncio.Queue(queue_size)
+    thread = ArchiveThread()
+    errors = []
+    state = {'eof': False}
+
+    async def feed():
+        try:
+            while 1:
+                data = await read_func(block_size)
+                await queue.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            errors.append(e)
+            await queue.put(b'')
+
+    def read_block():
+        # called by libarchive in the archive thread
+        if state['eof']:
+            return b''
+        data = thread.call_coroutine(queue.get())
+        if not data:
+            state['eof'] = True
+        return data
+
+    feeder = asyncio.ensure_future(feed())
+    try:
+        async with _open(read.custom_reader, AsyncArchiveRead, read_block,
+                         format_name, filter_name, zero_copy=True,
+                         thread=thread, errors=errors, **kwargs) as archive:
+            yield archive
+    finally:
+        feeder.cancel()
+        try:
+            # unblock the archive thread if it's waiting for data
+            queue.put_nowait(b'')
+        except asyncio.QueueFull:
+            pass
+
+
+def fd_writer(*args, **kwargs):
+    """Asynchronous version of `libarchive.write.fd_writer`."""
+    return _open(write.fd_writer, AsyncArchiveWrite, *args, **kwargs)
+
+
+def file_writer(*args, **kwargs):
+    """Asynchronous version of `libarchive.write.file_writer`."""
+    return _open(write.file_writer, AsyncArchiveWrite, *args, **kwargs)
+
+
+def memory_writer(*args, **kwargs):
+    """Asynchronous version of `libarchive.write.memory_writer`."""
+    return _open(write.memory_writer, AsyncArchiveWrite, *args, **kwargs)
+
+
+@asynccontextmanager
+async def stream_writer(write_func, format_name, filter_name=None,
+                        queue_size=DEFAULT_QUEUE_SIZE, **kwargs):
+    """Write an archive to a coroutine function.
+
+    `write_func(data)` is awaited for every block of the archive, like
+    `asyncio.StreamWriter.write` followed by `drain`. When it lags behind,
+    at most `queue_size` blocks are buffered before libarchive is paused.
+
+    Extra keyword arguments are passed to `custom_writer`.
+    """
+    queue = asyncio.Queue(queue_size)
+    thread = ArchiveThread()
+    errors = []
+
+    async def drain():
+        while 1:
+            data = await queue.get()
+            if data is None:
+                break
+            if errors:
+                # keep consuming so that the archive thread isn't blocked
+                continue
+            try:
+                await write_func(data)
+            except Exception as e:
+                errors.append(e)
+
+    def write_block(data):
+        # called by libarchive in the archive thread
+        if errors:
+            return ARCHIVE_FATAL
+        thread.call_coroutine(queue.put(bytes(data)))
+        return len(data)
+
+    drainer = asyncio.ensure_future(drain())
+    try:
+        async with _open(write.custom_writer, AsyncArchiveWrite, write_block,
+                         format_name, filter_name, thread=thread,
+                         errors=errors, **kwargs) as archive:
+            yield archive
+    finally:
+        await queue.put(None)
+        await drainer
+    if errors:
+        raise errors[0]
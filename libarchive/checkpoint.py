@@ -0,0 +1,318 @@
+from __future__ import division, print_function, unicode_literals
+
+from contextlib import contextmanager
+import lzma
+import struct
+import zlib
+
+from .exception import ArchiveError
+from .member_index import (
+    MemberIndex, build_member_index, check_member_name, index_path
+)
+from .read import custom_reader
+
+
+MAGIC = b'LACKPT1\n'
+CHECKPOINT = struct.Struct('<QQ')
+SCAN_BLOCK_SIZE = 1024 * 1024
+# upper bound of the output of a single decompression call
+OUTPUT_LIMIT = 1024 * 1024
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# skippable frames have magic numbers 0x184D2A50 to 0x184D2A5F
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_FCS_SIZES = (0, 2, 4, 8)
+ZSTD_DICT_ID_SIZES = (0, 1, 2, 4)
+ZSTD_BLOCK_RLE = 1
+
+# magic number -> function returning a new decompressor for one frame
+DECOMPRESSORS = {
+    b'\x1f\x8b': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    b'\xfd7zXZ\x00': lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ),
+}
+
+
+def checkpoints_path(archive_path):
+    """Return the path of the sidecar checkpoints file of an archive."""
+    return archive_path + '.ckpt'
+
+
+def scan_checkpoints(f):
+    """Return the restart points of the compressed stream in the file `f`.
+
+    Decompression can only restart at the beginning of a frame: a gzip
+    member, an xz stream or a zstd frame. The checkpoints are a sorted list
+    of `(compressed_offset, uncompressed_offset)` pairs, one per frame, so
+    there is only one for a file written as a single frame.
+    """
+    checkpoints = []
+    for _ in iter_frames(f, checkpoints, decode=False):
+        pass
+    return checkpoints
+
+
+def iter_frames(f, checkpoints, decode=True):
+    """Decompress the file `f` frame by frame.
+
+    Yields the decompressed data in chunks of at most `OUTPUT_LIMIT` bytes,
+    and appends the checkpoints to the list `checkpoints` along the way. With
+    `decode=False` the data may not be yielded, frames are then only
+    decompressed if that's needed to find their boundaries or sizes.
+    """
+    start = f.read(6)
+    f.seek(0)
+    if start.startswith(ZSTD_MAGIC):
+        frames = _iter_zstd_frames(f, checkpoints, decode)
+    else:
+        for magic, new_decompressor in DECOMPRESSORS.items():
+            if start.startswith(magic):
+                break
+        else:
+            raise ArchiveError('only gzip, xz and zstd streams can be '
+                               'checkpointed')
+        frames = _iter_frames(f, checkpoints, new_decompressor)
+    for data in frames:
+        yield data
+
+
+def _decompress(d, data):
+    """Feed `data` to the decompressor `d`, yield bounded chunks of output.
+    """
+    while 1:
+        out = d.decompress(data, OUTPUT_LIMIT)
+        if out:
+            yield out
+        if d.eof:
+            return
+        if hasattr(d, 'needs_input'):
+            # lzma keeps the unprocessed input
+            if d.needs_input:
+                return
+            data = b''
+        else:
+            # zlib returns it
+            data = d.unconsumed_tail
+            if not data and len(out) < OUTPUT_LIMIT:
+                return
+
+
+def _iter_frames(f, checkpoints, new_decompressor):
+    checkpoints.append((0, 0))
+    c_pos = u_pos = 0
+    d = new_decompressor()
+    while 1:
+        chunk = f.read(SCAN_BLOCK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            try:
+                for data in _decompress(d, chunk):
+                    u_pos += len(data)
+                    yield data
+            except (zlib.error, lzma.LZMAError):
+                if checkpoints[-1] == (c_pos, u_pos):
+                    # trailing padding after the last frame
+                    checkpoints.pop()
+                    return
+                raise
+            if not d.eof:
+                c_pos += len(chunk)
+                break
+            unused = d.unused_data
+            c_pos += len(chunk) - len(unused)
+            checkpoints.append((c_pos, u_pos))
+            d = new_decompressor()
+            chunk = unused
+    if checkpoints[-1] == (c_pos, u_pos):
+        checkpoints.pop()
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ArchiveError('truncated zstd frame')
+    return data
+
+
+def zstd_frame_size(f):
+    """Parse the zstd frame at the current position of `f`.
+
+    Returns `(compressed_size, content_size)`, the content size being `None`
+    if it isn't in the frame header, or `None` if there is no frame. Only the
+    headers are read, the position of `f` is left at the end of the frame.
+    """
+    magic = f.read(4)
+    if len(magic) < 4:
+        return None
+    value = struct.unpack('<I', magic)[0]
+    if value & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+        size = struct.unpack('<I', _read_exactly(f, 4))[0]
+        f.seek(size, 1)
+        return 8 + size, 0
+    if magic != ZSTD_MAGIC:
+        return None
+    start = f.tell() - 4
+    descriptor = bytearray(_read_exactly(f, 1))[0]
+    single_segment = descriptor & 0x20
+    fcs_size = ZSTD_FCS_SIZES[descriptor >> 6]
+    if not fcs_size and single_segment:
+        fcs_size = 1
+    header_size = (
+        (0 if single_segment else 1) +
+        ZSTD_DICT_ID_SIZES[descriptor & 3] + fcs_size
+    )
+    header = _read_exactly(f, header_size)
+    content_size = None
+    if fcs_size:
+        content_size = struct.unpack(
+            '<Q', header[-fcs_size:] + b'\0' * (8 - fcs_size)
+        )[0]
+        if fcs_size == 2:
+            content_size += 256
+    while 1:
+        block_header = struct.unpack('<I', _read_exactly(f, 3) + b'\0')[0]
+        block_type = (block_header >> 1) & 3
+        block_size = block_header >> 3
+        f.seek(1 if block_type == ZSTD_BLOCK_RLE else block_size, 1)
+        if block_header & 1:
+            break
+    if descriptor & 4:
+        # content checksum
+        f.seek(4, 1)
+    end = f.tell()
+    f.seek(0, 2)
+    if end > f.tell():
+        raise ArchiveError('truncated zstd frame')
+    f.seek(end)
+    return end - start, content_size
+
+
+def _iter_zstd_frames(f, checkpoints, decode):
+    c_pos = u_pos = 0
+    while 1:
+        f.seek(c_pos)
+        frame = zstd_frame_size(f)
+        if frame is None:
+            # end of the file, or trailing padding
+            break
+        checkpoints.append((c_pos, u_pos))
+        frame_size, content_size = frame
+        if decode or content_size is None:
+            # the frame is decompressed by libarchive's zstd filter
+            content_size = 0
+            f.seek(c_pos)
+            remaining = [frame_size]
+
+            def read():
+                data = f.read(min(remaining[0], SCAN_BLOCK_SIZE))
+                remaining[0] -= len(data)
+                return data
+
+            with custom_reader(read, 'raw', 'zstd', zero_copy=True) \
+                    as stream:
+                for entry in stream:
+                    for data in entry.get_blocks(OUTPUT_LIMIT):
+                        content_size += len(data)
+                        yield data
+        c_pos += frame_size
+        u_pos += content_size
+
+
+def save_checkpoints(checkpoints, path):
+    """Write a list of checkpoints to a file."""
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for checkpoint in checkpoints:
+            f.write(CHECKPOINT.pack(*checkpoint))
+
+
+def load_checkpoints(path):
+    """Read a list of checkpoints written by `save_checkpoints`."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ArchiveError('%s is not a checkpoints file' % path)
+    return [CHECKPOINT.unpack_from(data, pos)
+            for pos in range(len(MAGIC), len(data), CHECKPOINT.size)]
+
+
+def write_checkpoints(archive_path, format_name='tar'):
+    """Build the checkpoints and member index of a compressed archive.
+
+    The archive is decompressed once: the data found while looking for the
+    checkpoints is fed to libarchive to build the index. Both are saved next
+    to the archive. Returns `(checkpoints, index)`.
+    """
+    checkpoints = []
+    errors = []
+    with open(archive_path, 'rb') as f:
+        chunks = iter_frames(f, checkpoints)
+
+        def read():
+            try:
+                return next(chunks, b'')
+            except Exception as e:
+                # don't let the error be swallowed by the ctypes callback
+                errors.append(e)
+                return b''
+
+        try:
+            with custom_reader(read, format_name, 'none', zero_copy=True) \
+                    as archive:
+                index = build_member_index(archive)
+            # the end of the archive may be followed by more frames
+            for _ in chunks:
+                pass
+        except ArchiveError:
+            if errors:
+                raise errors[0]
+            raise
+        if errors:
+            raise errors[0]
+    save_checkpoints(checkpoints, checkpoints_path(archive_path))
+    index.save(index_path(archive_path))
+    return checkpoints, index
+
+
+@contextmanager
+def open_compressed_member(archive_path, name, checkpoints=None, index=None,
+                           format_name='tar'):
+    """Yield the `ArchiveEntry` of a single member of a compressed archive.
+
+    Decompression restarts at the last checkpoint before the member instead
+    of the beginning of the file. `checkpoints` and `index` default to the
+    sidecar files written by `write_checkpoints`.
+    """
+    if checkpoints is None:
+        checkpoints = load_checkpoints(checkpoints_path(archive_path))
+    if index is None:
+        index = MemberIndex.load(index_path(archive_path))
+    header_offset = index[name].header_offset
+    c_offset, u_offset = max(c for c in checkpoints if c[1] <= header_offset)
+    with open(archive_path, 'rb') as f:
+        f.seek(c_offset)
+        # first decompress the raw stream from the checkpoint...
+        with custom_reader(f.readinto, 'raw', block_size=SCAN_BLOCK_SIZE) \
+                as stream:
+            entries = iter(stream)
+            data = next(entries, None)
+            if data is None:
+                raise ArchiveError('no data after checkpoint %i in %s' %
+                                   (c_offset, archive_path))
+            # ...skip to the member's header...
+            skip = header_offset - u_offset
+            buf = bytearray(min(skip, SCAN_BLOCK_SIZE))
+            while skip:
+                n = data.readinto(memoryview(buf)[:skip])
+                if not n:
+                    raise ArchiveError('unexpected end of the compressed '
+                                       'stream in %s' % archive_path)
+                skip -= n
+            # ...then parse the rest as an archive
+            with custom_reader(data.readinto, format_name, 'none') as archive:
+                for entry in archive:
+                    check_member_name(entry, name, header_offset)
+                    yield entry
+                    return
+    raise ArchiveError('member %r not found at offset %i' %
+                       (name, header_offset))
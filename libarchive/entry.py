@@ -1,7 +1,11 @@
 from __future__ import division, print_function, unicode_literals
 
 from contextlib import contextmanager
-from ctypes import c_char_p, create_string_buffer, c_longlong, byref
+from io import RawIOBase
+from ctypes import (
+    byref, c_char, c_char_p, c_longlong, c_size_t, c_void_p,
+    create_string_buffer,
+)
 
 from . import ffi
 
@@ -22,6 +26,17 @@ def format_time(seconds, nanos):
     return int(seconds)
 
 
+def writable_buffer(buffer_):
+    """ return a flat byte view of buffer_ and a ctypes array sharing it """
+    view = memoryview(buffer_)
+    if view.format == 'B' and view.ndim == 1:
+        # already flat, Python 2's memoryview has no cast() and can't be
+        # passed to from_buffer
+        return view, (c_char * len(view)).from_buffer(buffer_)
+    view = view.cast('B')
+    return view, (c_char * len(view)).from_buffer(view)
+
+
 def entry_sparse_map(entry_p):
     """ return the next sparse entry as (offset, length) """
     offset = c_longlong()
@@ -33,7 +48,7 @@ def entry_sparse_map(entry_p):
     # loop until we see ARCHIVE_WARN
     while True:
         if ffi.entry_sparse_next(entry_p, off_p, len_p) != ffi.ARCHIVE_OK:
-            raise StopIteration()
+            return
 
         yield(offset.value, length.value)
 
@@ -83,7 +98,125 @@ class SparseMap(list):
         self.extend(entry_sparse_map(entry_p))
 
 
-class ArchiveEntry(object):
+class FileTypeMixin(object):
+    """ File type tests based on the `filetype` attribute """
+
+    __slots__ = ()
+
+    @property
+    def isblk(self):
+        return self.filetype & 0o170000 == 0o060000
+
+    @property
+    def ischr(self):
+        return self.filetype & 0o170000 == 0o020000
+
+    @property
+    def isdir(self):
+        return self.filetype & 0o170000 == 0o040000
+
+    @property
+    def isfifo(self):
+        return self.filetype & 0o170000 == 0o010000
+
+    @property
+    def issym(self):
+        return self.filetype & 0o170000 == 0o120000
+
+    @property
+    def isreg(self):
+        return self.filetype & 0o170000 == 0o100000
+
+    @property
+    def isfile(self):
+        return self.isreg
+
+    @property
+    def issock(self):
+        return self.filetype & 0o170000 == 0o140000
+
+    @property
+    def isdev(self):
+        return self.filetype & 0o170000 in (0o020000, 0o060000, 0o010000,
+                                            0o140000)
+
+
+class EntryInfo(FileTypeMixin):
+    """ Immutable snapshot of an archive entry's metadata
+
+        Built by `ArchiveEntry.snapshot`, it stays valid after the archive has
+        moved on to the next entry.
+    """
+
+    __slots__ = (
+        'pathname', 'linkpath', 'islnk', 'size', 'mode', 'filetype', 'uid',
+        'gid', 'atime', 'mtime', 'ctime', 'rdevmajor', 'rdevminor',
+    )
+
+    def __init__(self, *values):
+        if len(values) != len(self.__slots__):
+            raise TypeError('EntryInfo takes %i values, %i given' %
+                            (len(self.__slots__), len(values)))
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('EntryInfo objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('EntryInfo objects are immutable')
+
+    def __reduce__(self):
+        return (EntryInfo, self._values())
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, EntryInfo):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return 'EntryInfo(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__
+        )
+
+    def __str__(self):
+        return self.pathname
+
+    # aliases to get the same api as tarfile
+    path = property(lambda self: self.pathname)
+    name = property(lambda self: self.pathname)
+    linkname = property(lambda self: self.linkpath)
+
+
+class ArchiveEntryStream(RawIOBase):
+    """ Read-only, non-seekable file object over an archive entry's data
+
+        Wrap it in an `io.BufferedReader` to get buffered reads and `readline`.
+    """
+
+    def __init__(self, archive_entry):
+        super(ArchiveEntryStream, self).__init__()
+        self._arch_e = archive_entry
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        return self._arch_e.readinto(b)
+
+
+class ArchiveEntry(FileTypeMixin):
 
     def __init__(self, archive_p, entry_p):
         self._archive_p = archive_p
@@ -110,66 +243,138 @@ class ArchiveEntry(object):
     def gid(self):
         return ffi.entry_gid(self._entry_p)
 
-    def get_blocks(self, block_size=ffi.page_size):
+    def get_blocks(self, block_size=ffi.page_size, buffer=None):
+        """Yield the entry's data in blocks of at most `block_size` bytes.
+
+        If a writable `buffer` (bytearray, memoryview, array...) is given it
+        is reused for every block and the blocks are yielded as memoryviews
+        over it, so each one is only valid until the next is read.
+        """
         archive_p = self._archive_p
-        buf = create_string_buffer(block_size)
         read = ffi.read_data
+        if buffer is not None:
+            view, c_buf = writable_buffer(buffer)
+            size = len(view)
+            while 1:
+                r = read(archive_p, c_buf, size)
+                if r == 0:
+                    break
+                yield view[:r]
+            return
+        buf = create_string_buffer(block_size)
         while 1:
             r = read(archive_p, buf, block_size)
             if r == 0:
                 break
             yield buf.raw[0:r]
 
-    @property
-    def isblk(self):
-        return self.filetype & 0o170000 == 0o060000
-
-    @property
-    def ischr(self):
-        return self.filetype & 0o170000 == 0o020000
-
-    @property
-    def isdir(self):
-        return self.filetype & 0o170000 == 0o040000
-
-    @property
-    def isfifo(self):
-        return self.filetype & 0o170000 == 0o010000
+    def readinto(self, buffer):
+        """Read the entry's data into `buffer`, a writable buffer object.
+
+        Returns the number of bytes read, 0 once all the data has been read.
+        """
+        view, c_buf = writable_buffer(buffer)
+        return ffi.read_data(self._archive_p, c_buf, len(view))
+
+    def snapshot(self):
+        """Return an immutable `EntryInfo` copy of the entry's metadata.
+
+        Unlike the entry itself, it stays valid after moving on to the next
+        entry. All the attributes are fetched in a single pass, which is
+        cheaper than reading the equivalent properties one by one.
+        """
+        entry_p = self._entry_p
+        symlink_w = ffi.entry_symlink_w(entry_p)
+        hardlink_w = ffi.entry_hardlink_w(entry_p)
+        hardlink = hardlink_w or ffi.entry_hardlink(entry_p)
+        linkpath = (symlink_w or hardlink_w or ffi.entry_symlink(entry_p) or
+                    hardlink)
+        if ffi.entry_size_is_set(entry_p):
+            size = ffi.entry_size(entry_p)
+        else:
+            size = None
+        return EntryInfo(
+            self.pathname, linkpath, bool(hardlink), size,
+            ffi.entry_mode(entry_p), ffi.entry_filetype(entry_p),
+            ffi.entry_uid(entry_p), ffi.entry_gid(entry_p),
+            format_time(ffi.entry_atime(entry_p),
+                        ffi.entry_atime_nsec(entry_p)),
+            format_time(ffi.entry_mtime(entry_p),
+                        ffi.entry_mtime_nsec(entry_p)),
+            format_time(ffi.entry_ctime(entry_p),
+                        ffi.entry_ctime_nsec(entry_p)),
+            ffi.entry_rdevmajor(entry_p), ffi.entry_rdevminor(entry_p),
+        )
+
+    def open(self):
+        """Return an `ArchiveEntryStream` to read the entry's data from.
+
+        Like the other data methods it reads from the archive's current
+        position, so it must be used before moving on to the next entry.
+        """
+        return ArchiveEntryStream(self)
+
+    def iter_data_blocks(self):
+        """Yield the entry's data as ``(offset, memoryview)`` pairs.
+
+        The views point directly into libarchive's internal buffer, so no copy
+        is made, but they are only valid until the next block is requested.
+        """
+        archive_p = self._archive_p
+        buff, size, offset = c_void_p(), c_size_t(), c_longlong()
+        buff_p, size_p, offset_p = byref(buff), byref(size), byref(offset)
+        read_data_block = ffi.read_data_block
+        while 1:
+            r = read_data_block(archive_p, buff_p, size_p, offset_p)
+            if r == ffi.ARCHIVE_EOF:
+                break
+            length = size.value
+            if length:
+                view = memoryview(
+                    (c_char * length).from_address(buff.value)
+                ).cast('B')
+            else:
+                view = memoryview(b'')
+            yield offset.value, view
+
+    def get_blocks_view(self):
+        """Like `get_blocks`, but yields zero-copy memoryviews.
+
+        See `iter_data_blocks` for the lifetime of the views.
+        """
+        for offset, view in self.iter_data_blocks():
+            yield view
 
     @property
     def islnk(self):
         return bool(ffi.entry_hardlink_w(self._entry_p) or
                     ffi.entry_hardlink(self._entry_p))
 
-    @property
-    def issym(self):
-        return self.filetype & 0o170000 == 0o120000
-
     def _linkpath(self):
         return (ffi.entry_symlink_w(self._entry_p) or
                 ffi.entry_hardlink_w(self._entry_p) or
                 ffi.entry_symlink(self._entry_p) or
                 ffi.entry_hardlink(self._entry_p))
 
-    # aliases to get the same api as tarfile
-    linkpath = property(_linkpath)
-    linkname = property(_linkpath)
-
-    @property
-    def isreg(self):
-        return self.filetype & 0o170000 == 0o100000
+    def _gethardlink(self):
+        name = (ffi.entry_hardlink_w(self._entry_p) or
+                ffi.entry_hardlink(self._entry_p))
+        if isinstance(name, bytes):
+            return name.decode('utf8', 'surrogateescape')
+        else:
+            return name
 
-    @property
-    def isfile(self):
-        return self.isreg
+    def _sethardlink(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf8', 'surrogateescape')
+        ffi.entry_update_hardlink_utf8(self._entry_p, c_char_p(value))
 
-    @property
-    def issock(self):
-        return self.filetype & 0o170000 == 0o140000
+    # the target of a hard link, None for other entries
+    hardlink = property(_gethardlink, _sethardlink)
 
-    @property
-    def isdev(self):
-        return self.ischr or self.isblk or self.isfifo or self.issock
+    # aliases to get the same api as tarfile
+    linkpath = property(_linkpath)
+    linkname = property(_linkpath)
 
     @property
     def atime(self):
@@ -211,7 +416,7 @@ class ArchiveEntry(object):
 
     def _setpathname(self, value):
         if not isinstance(value, bytes):
-            value = value.encode('utf8')
+            value = value.encode('utf8', 'surrogateescape')
         ffi.entry_update_pathname_utf8(self._entry_p, c_char_p(value))
 
     pathname = property(_getpathname, _setpathname)
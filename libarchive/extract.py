@@ -1,12 +1,25 @@
 from __future__ import division, print_function, unicode_literals
 
+from collections import namedtuple
 from contextlib import contextmanager
 from ctypes import byref, c_longlong, c_size_t, c_void_p
+import errno
+from fnmatch import fnmatchcase
+import os
+from os.path import abspath
+from threading import Thread
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
 
 from .ffi import (
     write_disk_new, write_disk_set_options, write_free, write_header,
-    read_data_block, write_data_block, write_finish_entry, ARCHIVE_EOF
+    read_data_block, read_data_skip, write_data_block, write_finish_entry,
+    ARCHIVE_EOF, logger
 )
+from .exception import ArchiveError
 from .read import fd_reader, file_reader, memory_reader
 
 
@@ -26,6 +39,7 @@ EXTRACT_SPARSE = 0x1000
 EXTRACT_MAC_METADATA = 0x2000
 EXTRACT_NO_HFS_COMPRESSION = 0x4000
 EXTRACT_HFS_COMPRESSION_FORCED = 0x8000
+EXTRACT_SECURE_NOABSOLUTEPATHS = 0x10000
 
 
 @contextmanager
@@ -38,37 +52,571 @@ def new_archive_write_disk(flags):
         write_free(archive_p)
 
 
-def extract_entries(entries, flags=0):
-    """Extracts the given archive entries into the current directory.
+def disk_entry_writer(write_p):
+    """Returns a function that copies an archive entry to `write_p`.
     """
     buff, size, offset = c_void_p(), c_size_t(), c_longlong()
     buff_p, size_p, offset_p = byref(buff), byref(size), byref(offset)
-    with new_archive_write_disk(flags) as write_p:
+
+    def write_entry(entry):
+        write_header(write_p, entry._entry_p)
+        read_p = entry._archive_p
+        while 1:
+            r = read_data_block(read_p, buff_p, size_p, offset_p)
+            if r == ARCHIVE_EOF:
+                break
+            write_data_block(write_p, buff, size, offset)
+        write_finish_entry(write_p)
+
+    return write_entry
+
+
+def confine_path(path, flags=0):
+    """Returns `path` as a relative path that can't escape its directory.
+
+    A leading `/` is removed, unless `flags` include
+    `EXTRACT_SECURE_NOABSOLUTEPATHS`. Raises `ArchiveError` if the path is
+    refused, like libarchive does.
+    """
+    if path.startswith('/') or os.path.isabs(path):
+        if flags & EXTRACT_SECURE_NOABSOLUTEPATHS:
+            raise ArchiveError('Path is absolute: %s' % path)
+        path = path.lstrip('/')
+    if '..' in path.replace(os.sep, '/').split('/'):
+        raise ArchiveError("Path contains '..': %s" % path)
+    return path
+
+
+def relocate_entry(entry, dest=None, rewrite_path=None, flags=0):
+    """Changes the pathname (and hard link target) of an entry for extraction.
+
+    `rewrite_path(pathname)` returns the new relative path, or `None` to skip
+    the entry, and `dest` is the directory the path is then made relative to.
+    The paths are checked by `confine_path` first, so that the entry can't be
+    extracted outside of `dest`. Returns the relative path, or `None` if the
+    entry should be skipped.
+    """
+    path = entry.pathname
+    if rewrite_path:
+        path = rewrite_path(path)
+        if path is None:
+            return None
+    if dest:
+        path = confine_path(path, flags)
+        entry.pathname = os.path.join(dest, path)
+    elif rewrite_path:
+        entry.pathname = path
+    target = entry.hardlink
+    if target:
+        if rewrite_path:
+            target = rewrite_path(target) or target
+        if dest:
+            target = os.path.join(dest, confine_path(target, flags))
+        entry.hardlink = target
+    return path
+
+
+def disk_flags(flags, dest):
+    """Returns the flags to pass to libarchive for extraction into `dest`.
+
+    Once `dest` is applied the paths are absolute, and they have already been
+    checked by `confine_path`.
+    """
+    if dest:
+        flags &= ~EXTRACT_SECURE_NOABSOLUTEPATHS
+    return flags
+
+
+def extract_entries(entries, flags=0, dest=None, rewrite_path=None):
+    """Extracts the given archive entries into the current directory.
+
+    If `dest` is given the entries are extracted there instead, without
+    changing the current directory. See `relocate_entry` for `rewrite_path`.
+    """
+    if dest:
+        dest = abspath(dest)
+    with new_archive_write_disk(disk_flags(flags, dest)) as write_p:
+        write_entry = disk_entry_writer(write_p)
         for entry in entries:
-            write_header(write_p, entry._entry_p)
-            read_p = entry._archive_p
-            while 1:
-                r = read_data_block(read_p, buff_p, size_p, offset_p)
-                if r == ARCHIVE_EOF:
+            if dest or rewrite_path:
+                if relocate_entry(entry, dest, rewrite_path, flags) is None:
+                    continue
+            write_entry(entry)
+
+
+# flags that only libarchive knows how to honor
+PIPELINE_UNSUPPORTED_FLAGS = (
+    EXTRACT_ACL | EXTRACT_FFLAGS | EXTRACT_XATTR | EXTRACT_SECURE_SYMLINKS |
+    EXTRACT_NO_AUTODIR | EXTRACT_NO_OVERWRITE_NEWER | EXTRACT_MAC_METADATA |
+    EXTRACT_HFS_COMPRESSION_FORCED
+)
+
+
+def is_plain_path(path):
+    """Returns True if `path` is relative and contains no `..` component."""
+    return bool(path) and not os.path.isabs(path) and \
+        '..' not in path.replace(os.sep, '/').split('/')
+
+
+def open_extracted_file(info, flags):
+    """Opens the file to write an entry to, returns its descriptor.
+
+    Returns `None` if the file exists and `flags` include
+    `EXTRACT_NO_OVERWRITE`, in which case a warning is logged, like libarchive
+    does.
+    """
+    path = info.pathname
+    parent = os.path.dirname(path)
+    if parent:
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    open_flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+    if flags & EXTRACT_NO_OVERWRITE:
+        open_flags |= os.O_EXCL
+    else:
+        open_flags |= os.O_TRUNC
+        if flags & EXTRACT_UNLINK and os.path.lexists(path):
+            os.unlink(path)
+    try:
+        return os.open(path, open_flags, info.mode & 0o777)
+    except OSError as e:
+        if e.errno == errno.EEXIST and flags & EXTRACT_NO_OVERWRITE:
+            logger.warning('Not overwriting existing file %s', path)
+            return None
+        # like libarchive, replace an existing symlink instead of following
+        # it, and an existing empty directory
+        if e.errno == errno.ELOOP:
+            os.unlink(path)
+        elif e.errno == errno.EISDIR:
+            os.rmdir(path)
+        else:
+            raise
+        return os.open(path, open_flags, info.mode & 0o777)
+
+
+def finish_extracted_file(fd, info, flags):
+    try:
+        if info.size is not None:
+            # makes trailing holes of sparse files part of the file
+            os.ftruncate(fd, info.size)
+        if flags & EXTRACT_OWNER:
+            try:
+                os.fchown(fd, info.uid, info.gid)
+            except OSError as e:
+                if e.errno != errno.EPERM:
+                    raise
+                # like libarchive, only warn
+                logger.warning("Can't set user=%i/group=%i for %s",
+                               info.uid, info.gid, info.pathname)
+        if flags & EXTRACT_PERM:
+            os.fchmod(fd, info.mode & 0o7777)
+        if flags & EXTRACT_TIME:
+            os.utime(fd, (info.atime or info.mtime, info.mtime))
+    finally:
+        os.close(fd)
+
+
+def file_writer_thread(queue, flags, errors):
+    """Writes the files sent through `queue` until it receives `None`.
+    """
+    fd = None
+    while 1:
+        item = queue.get()
+        try:
+            if item is None:
+                # the main thread may have stopped in the middle of a file
+                if fd is not None:
+                    os.close(fd)
+                    fd = None
+                return
+            if errors:
+                # another thread failed, just drain the queue
+                continue
+            op, info, offset, data = item
+            if op == 'open':
+                fd = open_extracted_file(info, flags)
+            elif fd is None:
+                # the file is skipped
+                continue
+            elif op == 'data':
+                view = memoryview(data)
+                while view:
+                    n = os.pwrite(fd, view, offset)
+                    view, offset = view[n:], offset + n
+            else:
+                fd, fd_ = None, fd
+                finish_extracted_file(fd_, info, flags)
+        except Exception as e:
+            errors.append(e)
+            if fd is not None:
+                os.close(fd)
+                fd = None
+        finally:
+            queue.task_done()
+
+
+def extract_entries_pipelined(entries, flags=0, writers=4, queue_size=64,
+                              dest=None, rewrite_path=None):
+    """Extracts the given archive entries into the current directory.
+
+    The calling thread reads and decompresses the archive while `writers`
+    threads write the regular files with `os.pwrite`, so that decompression
+    and disk I/O overlap. Copies of the data blocks are passed through one
+    bounded queue of `queue_size` items per writer. The writer is chosen by
+    path, so that all the versions of a file are written in archive order
+    by the same thread and the last one wins.
+
+    Other entries (directories, links, devices...) and files whose path isn't
+    a plain relative path are extracted by libarchive in the calling thread.
+    If `flags` asks for features only libarchive implements (ACLs, xattrs,
+    secure symlinks...) this simply falls back to `extract_entries`.
+
+    `dest` and `rewrite_path` work as in `extract_entries`.
+    """
+    if flags & PIPELINE_UNSUPPORTED_FLAGS or not hasattr(os, 'pwrite'):
+        return extract_entries(entries, flags, dest, rewrite_path)
+    if dest:
+        dest = abspath(dest)
+    errors = []
+    queues = [Queue(queue_size) for _ in range(writers)]
+    threads = [Thread(target=file_writer_thread, args=(q, flags, errors))
+               for q in queues]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    with new_archive_write_disk(disk_flags(flags, dest)) as write_p:
+        write_entry = disk_entry_writer(write_p)
+        try:
+            # the paths of the files which may still be in a queue, and of
+            # their parent directories
+            queued = set()
+            queued_dirs = set()
+            for entry in entries:
+                if errors:
                     break
-                write_data_block(write_p, buff, size, offset)
-            write_finish_entry(write_p)
+                path = entry.pathname
+                if dest or rewrite_path:
+                    path = relocate_entry(entry, dest, rewrite_path, flags)
+                    if path is None:
+                        continue
+                if entry.isreg and not entry.islnk and is_plain_path(path):
+                    info = entry.snapshot()
+                    queue = queues[hash(info.pathname) % writers]
+                    key = os.path.normpath(info.pathname)
+                    queued.add(key)
+                    parent = os.path.dirname(key)
+                    while parent and parent not in queued_dirs:
+                        queued_dirs.add(parent)
+                        parent = os.path.dirname(parent)
+                    queue.put(('open', info, None, None))
+                    for offset, view in entry.iter_data_blocks():
+                        queue.put(('data', info, offset, bytes(view)))
+                    queue.put(('close', info, None, None))
+                    continue
+                key = os.path.normpath(entry.pathname)
+                if entry.islnk or key in queued or key in queued_dirs:
+                    # the link target, a previous version of the entry, or
+                    # files inside it may still be in a queue: they must be
+                    # written first, so that a symlink replacing a directory
+                    # is refused as it would be by `extract_entries` instead
+                    # of being followed by the writers
+                    for queue in queues:
+                        queue.join()
+                    queued.clear()
+                    queued_dirs.clear()
+                write_entry(entry)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+    if errors:
+        raise errors[0]
 
 
-def extract_fd(fd, flags=0):
+def make_matcher(pattern):
+    """Returns a function telling whether an entry matches `pattern`.
+
+    `pattern` can be a glob string, a compiled regular expression (searched
+    in the pathname), a callable taking the entry, or a list of those.
+    """
+    if isinstance(pattern, (list, tuple)):
+        matchers = [make_matcher(p) for p in pattern]
+        return lambda entry: any(m(entry) for m in matchers)
+    if hasattr(pattern, 'search'):
+        return lambda entry: bool(pattern.search(entry.pathname))
+    if callable(pattern):
+        return pattern
+    return lambda entry: fnmatchcase(entry.pathname, pattern)
+
+
+def filter_entries(entries, members=None, include=None, exclude=None):
+    """Yields the entries selected by the given criteria.
+
+    `members` is a collection of pathnames to select (trailing slashes are
+    ignored), `include` and `exclude` are patterns as accepted by
+    `make_matcher`. The data of the other entries is skipped without being
+    decompressed, and iteration stops as soon as all the `members` have been
+    found.
+    """
+    if members is not None:
+        members = set(m.rstrip('/') for m in members)
+        if not members:
+            return
+    include = include and make_matcher(include)
+    exclude = exclude and make_matcher(exclude)
+    for entry in entries:
+        if members is not None:
+            name = entry.pathname.rstrip('/')
+            wanted = name in members
+        else:
+            wanted = True
+        wanted = wanted and (not include or include(entry)) and \
+            not (exclude and exclude(entry))
+        if not wanted:
+            read_data_skip(entry._archive_p)
+            continue
+        yield entry
+        if members is not None:
+            members.discard(name)
+            if not members:
+                return
+
+
+def write_data_to_fd(entry, fd, skip_zeros=False):
+    """Writes the data of an archive entry into the file descriptor `fd`.
+
+    The file is first truncated to zero, then only the data blocks are
+    written, with `os.pwrite` at their offsets, and the file is extended to
+    the entry's size, so the holes of sparse entries stay holes in the file.
+    With `skip_zeros` blocks made only of zeros are left as holes too.
+    Returns the number of bytes written.
+    """
+    os.ftruncate(fd, 0)
+    zeros = memoryview(b'')
+    written = 0
+    for offset, data in entry.iter_data_blocks():
+        if skip_zeros:
+            if len(zeros) < len(data):
+                zeros = memoryview(bytes(bytearray(len(data))))
+            if data == zeros[:len(data)]:
+                continue
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset, written = data[n:], offset + n, written + n
+    size = entry.size
+    if size is not None:
+        os.ftruncate(fd, size)
+    return written
+
+
+class Sink(object):
+    """ Base class of the targets of `extract_to_sink`
+
+        For every entry `begin_entry(entry)` is called, then `write(offset,
+        data)` for each block of the entry's data, then `end_entry(entry)`.
+        `data` is a memoryview which is only valid during the call.
+    """
+
+    def begin_entry(self, entry):
+        pass
+
+    def write(self, offset, data):
+        raise NotImplementedError()
+
+    def end_entry(self, entry):
+        pass
+
+
+class MemorySink(Sink):
+    """ Sink collecting the regular files into the dict `files`
+
+        The data of each file is written into a single buffer sized from the
+        entry's header: a `bytearray`, or a memoryview into one preallocated
+        arena of `arena_size` bytes if that is given. Hard links map to the
+        same buffer as their target.
+    """
+
+    def __init__(self, arena_size=None):
+        self.files = {}
+        self._arena = None if arena_size is None else bytearray(arena_size)
+        self._arena_used = 0
+        self._buf = None
+
+    def begin_entry(self, entry):
+        self._buf = None
+        if entry.islnk:
+            target = self.files.get(entry.hardlink)
+            if target is not None:
+                self.files[entry.pathname] = target
+            return
+        if not entry.isreg:
+            return
+        size = entry.size
+        if self._arena is None:
+            self._buf = bytearray(size or 0)
+        else:
+            if size is None:
+                raise ArchiveError('%s has no size, it cannot be extracted '
+                                   'into an arena' % entry.pathname)
+            start, end = self._arena_used, self._arena_used + size
+            if end > len(self._arena):
+                raise ArchiveError('the arena is too small for %s' %
+                                   entry.pathname)
+            self._buf = memoryview(self._arena)[start:end]
+            self._arena_used = end
+        self.files[entry.pathname] = self._buf
+
+    def write(self, offset, data):
+        buf = self._buf
+        if buf is None:
+            return
+        end = offset + len(data)
+        if end > len(buf):
+            if isinstance(buf, memoryview):
+                raise ArchiveError('entry data exceeds the size in its header')
+            buf.extend(bytearray(end - len(buf)))
+        buf[offset:end] = data
+
+
+def extract_to_sink(entries, sink, **filters):
+    """Sends the given archive entries to a `Sink`.
+
+    See `filter_entries` for the keyword arguments selecting the entries.
+    """
+    for entry in filter_entries(entries, **filters):
+        sink.begin_entry(entry)
+        write = sink.write
+        for offset, data in entry.iter_data_blocks():
+            write(offset, data)
+        sink.end_entry(entry)
+
+
+def extract_to_memory(entries, arena_size=None, **filters):
+    """Extracts the regular files of the given entries into a dict.
+
+    Returns a dict mapping pathnames to the data of the files, see
+    `MemorySink` for the format of the data and `filter_entries` for the
+    keyword arguments selecting the entries.
+    """
+    sink = MemorySink(arena_size)
+    extract_to_sink(entries, sink, **filters)
+    return sink.files
+
+
+def extract_fd(fd, flags=0, dest=None, rewrite_path=None, **filters):
     """Extracts an archive from a file descriptor into the current directory.
+
+    See `filter_entries` for the keyword arguments selecting the entries and
+    `extract_entries` for `dest` and `rewrite_path`.
     """
     with fd_reader(fd) as archive:
-        extract_entries(archive, flags)
+        extract_entries(filter_entries(archive, **filters), flags, dest,
+                        rewrite_path)
+
 
+def extract_file(filepath, flags=0, dest=None, rewrite_path=None,
+                 **filters):
+    """Extracts an archive from a file into the current directory.
 
-def extract_file(filepath, flags=0):
-    """Extracts an archive from a file into the current directory."""
+    See `filter_entries` for the keyword arguments selecting the entries and
+    `extract_entries` for `dest` and `rewrite_path`.
+    """
     with file_reader(filepath) as archive:
-        extract_entries(archive, flags)
+        extract_entries(filter_entries(archive, **filters), flags, dest,
+                        rewrite_path)
+
 
+def extract_memory(buffer_, flags=0, dest=None, rewrite_path=None,
+                   **filters):
+    """Extracts an archive from memory into the current directory.
 
-def extract_memory(buffer_, flags=0):
-    """Extracts an archive from memory into the current directory."""
+    See `filter_entries` for the keyword arguments selecting the entries and
+    `extract_entries` for `dest` and `rewrite_path`.
+    """
     with memory_reader(buffer_) as archive:
-        extract_entries(archive, flags)
+        extract_entries(filter_entries(archive, **filters), flags, dest,
+                        rewrite_path)
+
+
+ExtractResult = namedtuple('ExtractResult', 'path dest_dir error')
+
+
+def cpu_count():
+    """Returns the number of CPUs, or 1 if it can't be determined."""
+    try:
+        from os import cpu_count
+    except ImportError:  # pragma: no cover
+        from multiprocessing import cpu_count
+    try:
+        return cpu_count() or 1
+    except NotImplementedError:  # pragma: no cover
+        return 1
+
+
+def extract_many(paths, dest_dirs, flags=0, workers=None, max_pending=None,
+                 progress=None):
+    """Extracts archive files in parallel, each into its own directory.
+
+    The archives are dispatched to a pool of `workers` processes, with at most
+    `max_pending` of them (twice the number of workers by default) queued at
+    any time so that `paths` and `dest_dirs` can be lazy iterables.
+    `progress(result, done)` is called in the calling process as each archive
+    completes.
+
+    Returns a list of `ExtractResult` in the order of `paths`; `error` is the
+    exception raised while extracting that archive, or `None`. If a worker
+    process dies the archives it was handling, and the others queued in the
+    pool at that time, get a `BrokenProcessPool` error, and a new pool is
+    started for the rest.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    workers = workers or cpu_count()
+    max_pending = max_pending or 2 * workers
+    pending, results = {}, {}
+
+    def collect(futures):
+        """Records the results, returns True if the pool is broken."""
+        broken = False
+        for future in futures:
+            i, result = pending.pop(future)
+            error = future.exception()
+            broken = broken or isinstance(error, BrokenProcessPool)
+            result = result._replace(error=error)
+            results[i] = result
+            if progress:
+                progress(result, len(results))
+        return broken
+
+    executor = ProcessPoolExecutor(workers)
+    broken = False
+    try:
+        for i, (path, dest_dir) in enumerate(zip(paths, dest_dirs)):
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                broken = collect(done) or broken
+            while 1:
+                if broken:
+                    # a worker died (e.g. killed by a signal), start a new pool
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(workers)
+                    broken = False
+                try:
+                    future = executor.submit(
+                        extract_file, abspath(path), flags, abspath(dest_dir)
+                    )
+                    break
+                except BrokenProcessPool:
+                    # the archives pending in the broken pool have failed
+                    collect(wait(pending)[0])
+                    broken = True
+            pending[future] = (i, ExtractResult(path, dest_dir, None))
+        collect(wait(pending)[0])
+    finally:
+        executor.shutdown()
+    return [results[i] for i in range(len(results))]
@@ -47,6 +47,10 @@ WRITE_CALLBACK = CFUNCTYPE(
 READ_CALLBACK = CFUNCTYPE(
     c_ssize_t, c_void_p, c_void_p, POINTER(c_void_p)
 )
+SEEK_CALLBACK = CFUNCTYPE(
+    c_longlong, c_void_p, c_void_p, c_longlong, c_int
+)
+SKIP_CALLBACK = CFUNCTYPE(c_longlong, c_void_p, c_void_p, c_longlong)
 OPEN_CALLBACK = CFUNCTYPE(c_int, c_void_p, c_void_p)
 CLOSE_CALLBACK = CFUNCTYPE(c_int, c_void_p, c_void_p)
 VOID_CB = lambda *_: ARCHIVE_OK
@@ -143,6 +147,7 @@ ffi('entry_set_mtime', [c_archive_entry_p, c_int, c_long], None)
 ffi('entry_set_ctime', [c_archive_entry_p, c_int, c_long], None)
 
 ffi('entry_update_pathname_utf8', [c_archive_entry_p, c_char_p], None)
+ffi('entry_update_hardlink_utf8', [c_archive_entry_p, c_char_p], None)
 
 ffi('entry_sparse_clear', [c_archive_entry_p], None)
 ffi('entry_sparse_count', [c_archive_entry_p], c_int)
@@ -170,8 +175,8 @@ for f_name in list(READ_FORMATS):
         READ_FORMATS.remove(f_name)
 
 READ_FILTERS = set((
-    'all', 'bzip2', 'compress', 'grzip', 'gzip', 'lrzip', 'lzip', 'lzma',
-    'lzop', 'none', 'rpm', 'uu', 'xz'
+    'all', 'bzip2', 'compress', 'grzip', 'gzip', 'lrzip', 'lz4', 'lzip',
+    'lzma', 'lzop', 'none', 'rpm', 'uu', 'xz', 'zstd'
 ))
 for f_name in list(READ_FILTERS):
     try:
@@ -180,9 +185,23 @@ for f_name in list(READ_FILTERS):
         logger.warning('read filter "%s" is not supported' % f_name)
         READ_FILTERS.remove(f_name)
 
+ffi('read_set_options', [c_archive_p, c_char_p], c_int, check_int)
+ffi('read_set_format_option', [c_archive_p, c_char_p, c_char_p, c_char_p],
+    c_int, check_int)
+ffi('read_set_filter_option', [c_archive_p, c_char_p, c_char_p, c_char_p],
+    c_int, check_int)
+
 ffi('read_open',
     [c_archive_p, c_void_p, OPEN_CALLBACK, READ_CALLBACK, CLOSE_CALLBACK],
     c_int, check_int)
+ffi('read_set_open_callback', [c_archive_p, OPEN_CALLBACK], c_int, check_int)
+ffi('read_set_read_callback', [c_archive_p, READ_CALLBACK], c_int, check_int)
+ffi('read_set_seek_callback', [c_archive_p, SEEK_CALLBACK], c_int, check_int)
+ffi('read_set_skip_callback', [c_archive_p, SKIP_CALLBACK], c_int, check_int)
+ffi('read_set_close_callback', [c_archive_p, CLOSE_CALLBACK],
+    c_int, check_int)
+ffi('read_set_callback_data', [c_archive_p, c_void_p], c_int, check_int)
+ffi('read_open1', [c_archive_p], c_int, check_int)
 ffi('read_open_fd', [c_archive_p, c_int, c_size_t], c_int, check_int)
 ffi('read_open_filename_w', [c_archive_p, c_wchar_p, c_size_t],
     c_int, check_int)
@@ -191,9 +210,16 @@ ffi('read_open_memory', [c_archive_p, c_void_p, c_size_t], c_int, check_int)
 ffi('read_next_header', [c_archive_p, POINTER(c_void_p)], c_int, check_int)
 ffi('read_next_header2', [c_archive_p, c_void_p], c_int, check_int)
 
+ffi('read_header_position', [c_archive_p], c_longlong)
+
 ffi('read_close', [c_archive_p], c_int, check_int)
 ffi('read_free', [c_archive_p], c_int, check_int)
 
+# archive_filter
+
+ffi('filter_count', [c_archive_p], c_int)
+ffi('filter_bytes', [c_archive_p, c_int], c_longlong)
+
 # archive_read_disk
 
 ffi('read_disk_new', [], c_archive_p, check_null)
@@ -230,8 +256,8 @@ for f_name in list(WRITE_FORMATS):
         WRITE_FORMATS.remove(f_name)
 
 WRITE_FILTERS = set((
-    'b64encode', 'bzip2', 'compress', 'grzip', 'gzip', 'lrzip', 'lzip', 'lzma',
-    'lzop', 'uuencode', 'xz'
+    'b64encode', 'bzip2', 'compress', 'grzip', 'gzip', 'lrzip', 'lz4', 'lzip',
+    'lzma', 'lzop', 'uuencode', 'xz', 'zstd'
 ))
 for f_name in list(WRITE_FILTERS):
     try:
@@ -240,6 +266,12 @@ for f_name in list(WRITE_FILTERS):
         logger.warning('write filter "%s" is not supported' % f_name)
         WRITE_FILTERS.remove(f_name)
 
+ffi('write_set_options', [c_archive_p, c_char_p], c_int, check_int)
+ffi('write_set_format_option', [c_archive_p, c_char_p, c_char_p, c_char_p],
+    c_int, check_int)
+ffi('write_set_filter_option', [c_archive_p, c_char_p, c_char_p, c_char_p],
+    c_int, check_int)
+
 ffi('write_open',
     [c_archive_p, c_void_p, OPEN_CALLBACK, WRITE_CALLBACK, CLOSE_CALLBACK],
     c_int, check_int)
@@ -265,3 +297,20 @@ ffi('write_fail', [c_archive_p], c_int, check_int)
 
 ffi('write_close', [c_archive_p], c_int, check_int)
 ffi('write_free', [c_archive_p], c_int, check_int)
+
+
+# libc, to map files read-only without going through the mmap module, which
+# only exposes the address of writable (thus memory-charged) mappings
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc_mmap = libc.mmap
+    libc_mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_long]
+    libc_mmap.restype = c_void_p
+    libc_munmap = libc.munmap
+    libc_munmap.argtypes = [c_void_p, c_size_t]
+    libc_munmap.restype = c_int
+    MAP_FAILED = c_void_p(-1).value
+except (OSError, AttributeError, TypeError):  # pragma: no cover
+    # TypeError: CDLL(None) isn't supported on Windows
+    libc_mmap = libc_munmap = None
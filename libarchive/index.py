@@ -0,0 +1,149 @@
+from __future__ import division, print_function, unicode_literals
+
+from array import array
+
+from . import ffi
+from .entry import new_archive_entry
+from .ffi import ARCHIVE_EOF
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+class ArchiveIndex(object):
+    """ Columnar index of the entries of an archive
+
+        The pathnames are packed into one buffer, `names`, the pathname of the
+        entry `i` being `names[offsets[i]:offsets[i+1]]` (UTF-8 encoded). The
+        other attributes are stored in `array.array` columns, which can be
+        wrapped without copying by `numpy.frombuffer`. Unknown sizes are -1.
+
+        The 64-bit `array.array` columns (typecode 'q') require Python 3.3 or
+        later.
+    """
+
+    def __init__(self, names, offsets, sizes, mtimes, modes, filetypes):
+        self.names = names
+        self.offsets = offsets
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.modes = modes
+        self.filetypes = filetypes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def pathname(self, i):
+        name = self.names[self.offsets[i]:self.offsets[i + 1]]
+        return name.decode('utf8', 'surrogateescape')
+
+    def pathnames(self, indices=None):
+        """Return the pathnames of the given entries, or of all of them."""
+        if indices is None:
+            indices = range(len(self))
+        return [self.pathname(i) for i in indices]
+
+    def select(self, extensions=None, min_size=None, max_size=None,
+               filetype=None):
+        """Return the indices of the entries matching all the given criteria.
+
+        `extensions` is a list of pathname suffixes (e.g. `['.jpg', '.png']`),
+        `min_size` and `max_size` are inclusive bounds which exclude entries
+        of unknown size, and `filetype` is a `stat.S_IF*` constant.
+
+        The selection is vectorized with NumPy when it is available, in which
+        case a NumPy array is returned instead of an `array.array`.
+        """
+        if extensions is not None:
+            extensions = tuple(
+                e if isinstance(e, bytes) else e.encode('utf8')
+                for e in extensions
+            )
+        if numpy is not None:
+            return self._select_numpy(extensions, min_size, max_size,
+                                      filetype)
+        names, offsets = self.names, self.offsets
+        sizes, filetypes = self.sizes, self.filetypes
+        r = array('q')
+        for i in range(len(self)):
+            size = sizes[i]
+            if min_size is not None and (size < 0 or size < min_size):
+                continue
+            if max_size is not None and (size < 0 or size > max_size):
+                continue
+            if filetype is not None and filetypes[i] & 0o170000 != filetype:
+                continue
+            if extensions is not None:
+                name = names[offsets[i]:offsets[i + 1]]
+                if not name.endswith(extensions):
+                    continue
+            r.append(i)
+        return r
+
+    def _select_numpy(self, extensions, min_size, max_size, filetype):
+        mask = numpy.ones(len(self), dtype=bool)
+        sizes = numpy.frombuffer(self.sizes, dtype=numpy.int64)
+        if min_size is not None:
+            mask &= (sizes >= 0) & (sizes >= min_size)
+        if max_size is not None:
+            mask &= (sizes >= 0) & (sizes <= max_size)
+        if filetype is not None:
+            filetypes = numpy.frombuffer(self.filetypes, dtype=numpy.intc)
+            mask &= (filetypes & 0o170000) == filetype
+        if extensions is not None:
+            names = numpy.frombuffer(self.names, dtype=numpy.uint8)
+            offsets = numpy.frombuffer(self.offsets, dtype=numpy.int64)
+            ends = offsets[1:]
+            lengths = ends - offsets[:-1]
+            matches = numpy.zeros(len(self), dtype=bool)
+            for ext in extensions:
+                m = lengths >= len(ext)
+                # compare the last bytes of every name, one position at a time
+                for k, byte in enumerate(bytearray(ext)):
+                    if not len(names):
+                        break
+                    positions = numpy.where(m, ends - len(ext) + k, 0)
+                    m &= names[positions] == byte
+                matches |= m
+            mask &= matches
+        return numpy.flatnonzero(mask)
+
+
+def build_index(archive):
+    """Walk an `ArchiveRead` and return an `ArchiveIndex` of its entries.
+
+    No Python object is created per entry (apart from the pathname), and the
+    data of the entries is skipped.
+    """
+    archive_p = archive._pointer
+    names = bytearray()
+    offsets = array('q', [0])
+    sizes, mtimes = array('q'), array('q')
+    modes, filetypes = array('i'), array('i')
+    read_next_header2 = ffi.read_next_header2
+    read_data_skip = ffi.read_data_skip
+    with new_archive_entry() as entry_p:
+        while 1:
+            r = read_next_header2(archive_p, entry_p)
+            if r == ARCHIVE_EOF:
+                break
+            # same source as `ArchiveEntry.pathname`, which prefers the wide
+            # name to the one in the locale's encoding
+            name = (ffi.entry_pathname_w(entry_p) or
+                    ffi.entry_pathname(entry_p) or '')
+            if not isinstance(name, bytes):
+                name = name.encode('utf8', 'surrogateescape')
+            names += name
+            offsets.append(len(names))
+            if ffi.entry_size_is_set(entry_p):
+                sizes.append(ffi.entry_size(entry_p))
+            else:
+                sizes.append(-1)
+            mtimes.append(ffi.entry_mtime(entry_p))
+            modes.append(ffi.entry_mode(entry_p))
+            filetypes.append(ffi.entry_filetype(entry_p))
+            read_data_skip(archive_p)
+    return ArchiveIndex(bytes(names), offsets, sizes, mtimes, modes,
+                        filetypes)
@@ -0,0 +1,124 @@
+from __future__ import division, print_function, unicode_literals
+
+from collections import namedtuple
+from contextlib import contextmanager
+import struct
+
+from . import ffi
+from .exception import ArchiveError
+from .read import fd_reader, file_reader
+
+
+MAGIC = b'LAMIDX1\n'
+RECORD = struct.Struct('<QQqI')
+
+MemberLocation = namedtuple(
+    'MemberLocation', 'header_offset data_offset size'
+)
+
+
+class MemberIndex(dict):
+    """ Map of member pathnames to their `MemberLocation` in an archive
+
+        `header_offset` is where the member's headers start (including any
+        extended headers) and `data_offset` where its data starts. Sizes are
+        -1 when unknown.
+    """
+
+    def save(self, path):
+        """Write the index to a file."""
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            for name, loc in self.items():
+                name = name.encode('utf8', 'surrogateescape')
+                f.write(RECORD.pack(loc.header_offset, loc.data_offset,
+                                    loc.size, len(name)))
+                f.write(name)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by `save`."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ArchiveError('%s is not a member index' % path)
+        index = cls()
+        pos = len(MAGIC)
+        while pos < len(data):
+            header_offset, data_offset, size, name_len = \
+                RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            name = data[pos:pos + name_len].decode('utf8', 'surrogateescape')
+            pos += name_len
+            index[name] = MemberLocation(header_offset, data_offset, size)
+        return index
+
+
+def index_path(archive_path):
+    """Return the path of the sidecar index of an archive."""
+    return archive_path + '.idx'
+
+
+def build_member_index(archive, allow_filters=False):
+    """Walk an uncompressed `ArchiveRead` and return its `MemberIndex`.
+
+    With `allow_filters` compressed archives are accepted too, the offsets
+    are then positions in the uncompressed stream.
+    """
+    archive_p = archive._pointer
+    index = MemberIndex()
+    for entry in archive:
+        if not allow_filters and ffi.filter_count(archive_p) > 1:
+            raise ArchiveError(
+                'member indexes can only be built for uncompressed archives'
+            )
+        size = entry.size
+        index[entry.pathname] = MemberLocation(
+            ffi.read_header_position(archive_p),
+            ffi.filter_bytes(archive_p, 0),
+            -1 if size is None else size,
+        )
+    return index
+
+
+def write_member_index(archive_path, format_name='tar'):
+    """Build the index of an archive file and save it next to the archive.
+
+    Returns the index.
+    """
+    with file_reader(archive_path, format_name, 'none') as archive:
+        index = build_member_index(archive)
+    index.save(index_path(archive_path))
+    return index
+
+
+def check_member_name(entry, name, offset):
+    """Raise `ArchiveError` if `entry` isn't the expected member."""
+    if entry.pathname != name:
+        raise ArchiveError(
+            'stale index: found member %r instead of %r at offset %i' %
+            (entry.pathname, name, offset)
+        )
+
+
+@contextmanager
+def open_member(archive_path, name, index=None, format_name='tar'):
+    """Yield the `ArchiveEntry` of a single member of an archive.
+
+    The archive is read starting at the member's header, as recorded in
+    `index`, which defaults to the archive's sidecar index. Raises `KeyError`
+    if the member isn't in the index, and `ArchiveError` if the index is stale
+    (another member is found at the recorded offset).
+    """
+    if index is None:
+        index = MemberIndex.load(index_path(archive_path))
+    loc = index[name]
+    with open(archive_path, 'rb') as f:
+        f.seek(loc.header_offset)
+        with fd_reader(f.fileno(), format_name, 'none') as archive:
+            for entry in archive:
+                check_member_name(entry, name, loc.header_offset)
+                yield entry
+                return
+    raise ArchiveError('member %r not found at offset %i' %
+                       (name, loc.header_offset))
@@ -1,15 +1,25 @@
 from __future__ import division, print_function, unicode_literals
 
 from contextlib import contextmanager
-from ctypes import cast, c_void_p, POINTER, create_string_buffer
+from ctypes import (
+    addressof, cast, c_char, c_char_p, c_void_p, create_string_buffer,
+    get_errno,
+)
+import mmap
+import os
 from os import fstat, stat
+from stat import S_ISREG
 
 from . import ffi
 from .ffi import (ARCHIVE_EOF, OPEN_CALLBACK, READ_CALLBACK, CLOSE_CALLBACK,
-                  VOID_CB, page_size)
+                  SEEK_CALLBACK, SKIP_CALLBACK, VOID_CB, page_size)
 from .entry import ArchiveEntry, new_archive_entry
 
 
+DEFAULT_BLOCK_SIZE = 4096
+AUTO_BLOCK_SIZE = 1024 * 1024
+
+
 class ArchiveRead(object):
 
     def __init__(self, archive_p):
@@ -28,84 +38,263 @@ class ArchiveRead(object):
                     return
                 yield entry
 
+    def iter_headers(self):
+        """Iterates through the archive's entries without reading their data.
+
+        Yields `EntryInfo` snapshots. The data of each entry is skipped
+        explicitly, which seeks over it when the source allows it.
+        """
+        archive_p = self._pointer
+        read_next_header2 = ffi.read_next_header2
+        read_data_skip = ffi.read_data_skip
+        with new_archive_entry() as entry_p:
+            entry = ArchiveEntry(archive_p, entry_p)
+            while 1:
+                r = read_next_header2(archive_p, entry_p)
+                if r == ARCHIVE_EOF:
+                    return
+                yield entry.snapshot()
+                read_data_skip(archive_p)
+
 
 @contextmanager
-def new_archive_read(format_name='all', filter_name='all'):
+def new_archive_read(format_name='all', filter_name='all', options=None):
     """Creates an archive struct suitable for reading from an archive.
 
+    `options` is a string of comma-separated libarchive options, e.g.
+    `'zip:ignorecrc32'`, see the archive_read_set_options(3) manpage.
+
     Returns a pointer if successful. Raises ArchiveError on error.
     """
     archive_p = ffi.read_new()
-    getattr(ffi, 'read_support_filter_'+filter_name)(archive_p)
-    getattr(ffi, 'read_support_format_'+format_name)(archive_p)
+    try:
+        getattr(ffi, 'read_support_filter_'+filter_name)(archive_p)
+        getattr(ffi, 'read_support_format_'+format_name)(archive_p)
+        if options:
+            ffi.read_set_options(archive_p, encode_options(options))
+    except BaseException:
+        ffi.read_free(archive_p)
+        raise
     try:
         yield archive_p
     finally:
         ffi.read_free(archive_p)
 
 
+def encode_options(options):
+    """Return an options string as bytes, for the `*_set_options` functions.
+    """
+    if isinstance(options, bytes):
+        return options
+    return options.encode('utf8')
+
+
+def pin_buffer(data):
+    """Return `(address, length, keepalive)` for the bytes-like `data`.
+
+    Writable buffers and bytes are shared without copying, other read-only
+    buffers are copied once.
+    """
+    view = memoryview(data).cast('B')
+    length = len(view)
+    if not length:
+        return None, 0, None
+    if not view.readonly:
+        c_buf = (c_char * length).from_buffer(view)
+    elif isinstance(data, bytes):
+        c_buf = c_char_p(data)
+        return cast(c_buf, c_void_p).value, length, c_buf
+    else:
+        c_buf = (c_char * length).from_buffer_copy(view)
+    return addressof(c_buf), length, c_buf
+
+
 @contextmanager
 def custom_reader(
         readinto_func, format_name, filter_name='all',
         open_func=VOID_CB, close_func=VOID_CB, block_size=page_size,
-        archive_read_class=ArchiveRead
+        archive_read_class=ArchiveRead, seek_func=None, skip_func=None,
+        zero_copy=False, options=None
 ):
+    """Read an archive using callback functions.
+
+    `readinto_func(buf)` fills `buf` and returns the number of bytes written.
+    With `zero_copy=True` it is instead called without arguments and returns
+    a bytes-like object (empty at the end), which is handed to libarchive
+    as is and kept alive until the next call.
 
-    # cache a buffer here - we need something to last after the callback returns
-    buf = create_string_buffer(block_size)
+    If the source supports random access, `seek_func(offset, whence)` should
+    return the new absolute position (like `io.IOBase.seek`) and lets
+    libarchive jump around, e.g. to read a zip's central directory.
+    `skip_func(request)` should advance by at most `request` bytes and return
+    the number of bytes actually skipped.
 
-    def read_cb_internal(archive_p, context, bufptr):
-        # readinto buf, returns number of bytes read
-        length = readinto_func(buf)
+    See `new_archive_read` for the `options` argument.
+    """
 
-        # turn our string data into a void * we can pass back
-        void_p = cast(buf, c_void_p)
+    if zero_copy:
+        # keep the last returned buffer alive until libarchive asks for more
+        pinned = [None]
 
-        # decipher our pointer type, then set return buffer pointer
-        buf_p = cast(bufptr, POINTER(c_void_p))
-        buf_p[0] = void_p
+        def read_cb_internal(archive_p, context, bufptr):
+            address, length, pinned[0] = pin_buffer(readinto_func())
+            bufptr[0] = address
+            return length
+    else:
+        # cache a buffer here - we need something to last after the callback
+        # returns
+        buf = create_string_buffer(block_size)
+        buf_address = addressof(buf)
 
-        return length
+        def read_cb_internal(archive_p, context, bufptr):
+            # readinto buf, returns number of bytes read
+            length = readinto_func(buf)
+            bufptr[0] = buf_address
+            return length
 
     open_cb = OPEN_CALLBACK(open_func)
     read_cb = READ_CALLBACK(read_cb_internal)
     close_cb = CLOSE_CALLBACK(close_func)
 
-    with new_archive_read(format_name, filter_name) as archive_p:
-        ffi.read_open(archive_p, None, open_cb, read_cb, close_cb)
+    if seek_func:
+        seek_cb = SEEK_CALLBACK(lambda a, c, offset, whence:
+                                seek_func(offset, whence))
+    if skip_func:
+        skip_cb = SKIP_CALLBACK(lambda a, c, request: skip_func(request))
+
+    with new_archive_read(format_name, filter_name, options) as archive_p:
+        ffi.read_set_open_callback(archive_p, open_cb)
+        ffi.read_set_read_callback(archive_p, read_cb)
+        if seek_func:
+            ffi.read_set_seek_callback(archive_p, seek_cb)
+        if skip_func:
+            ffi.read_set_skip_callback(archive_p, skip_cb)
+        ffi.read_set_close_callback(archive_p, close_cb)
+        ffi.read_set_callback_data(archive_p, None)
+        ffi.read_open1(archive_p)
         yield archive_read_class(archive_p)
 
 
+def get_block_size(stat_func, target, block_size=None):
+    """Resolve the `block_size` argument of `fd_reader` and `file_reader`.
+
+    `None` means the preferred I/O size of the file (`st_blksize`), and
+    `'auto'` means a large block (up to `AUTO_BLOCK_SIZE`) for big files and
+    streams (pipes, sockets...), so that fewer read syscalls are made. Any
+    other value is used as is.
+    """
+    if block_size is not None and block_size != 'auto':
+        return block_size
+    try:
+        st = stat_func(target)
+        blksize = st.st_blksize
+    except (OSError, AttributeError):  # pragma: no cover
+        return DEFAULT_BLOCK_SIZE
+    if block_size is None:
+        return blksize
+    if not S_ISREG(st.st_mode):
+        # pipes and sockets have no size, but they are streamed
+        return AUTO_BLOCK_SIZE
+    size = min(max(st.st_size, blksize), AUTO_BLOCK_SIZE)
+    # round up to a multiple of the preferred I/O size
+    return -(-size // blksize) * blksize
+
+
 @contextmanager
-def fd_reader(fd, format_name='all', filter_name='all', block_size=4096):
+def fd_reader(fd, format_name='all', filter_name='all', block_size=None,
+              sequential=False, options=None):
     """Read an archive from a file descriptor.
+
+    See `get_block_size` for the accepted `block_size` values. If `sequential`
+    is true the kernel is advised that the file will be read sequentially,
+    which usually increases readahead. See `new_archive_read` for the
+    `options` argument.
     """
-    with new_archive_read(format_name, filter_name) as archive_p:
-        try:
-            block_size = fstat(fd).st_blksize
-        except (OSError, AttributeError):  # pragma: no cover
-            pass
+    with new_archive_read(format_name, filter_name, options) as archive_p:
+        block_size = get_block_size(fstat, fd, block_size)
+        if sequential and hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # e.g. ESPIPE on pipes, the advice is only a hint anyway
+                pass
         ffi.read_open_fd(archive_p, fd, block_size)
         yield ArchiveRead(archive_p)
 
 
 @contextmanager
-def file_reader(path, format_name='all', filter_name='all', block_size=4096):
+def file_reader(path, format_name='all', filter_name='all', block_size=None,
+                sequential=False, options=None):
     """Read an archive from a file.
+
+    See `fd_reader` for the `block_size`, `sequential` and `options` arguments.
     """
-    with new_archive_read(format_name, filter_name) as archive_p:
-        try:
-            block_size = stat(path).st_blksize
-        except (OSError, AttributeError):  # pragma: no cover
-            pass
+    if sequential:
+        # the advice applies to an open file, so we have to open it ourselves
+        with open(path, 'rb') as f:
+            with fd_reader(f.fileno(), format_name, filter_name, block_size,
+                           sequential, options) as archive:
+                yield archive
+        return
+    with new_archive_read(format_name, filter_name, options) as archive_p:
+        block_size = get_block_size(stat, path, block_size)
         ffi.read_open_filename_w(archive_p, path, block_size)
         yield ArchiveRead(archive_p)
 
 
 @contextmanager
-def memory_reader(buf, format_name='all', filter_name='all'):
+def memory_reader(buf, format_name='all', filter_name='all', options=None):
     """Read an archive from memory.
     """
-    with new_archive_read(format_name, filter_name) as archive_p:
+    with new_archive_read(format_name, filter_name, options) as archive_p:
         ffi.read_open_memory(archive_p, cast(buf, c_void_p), len(buf))
         yield ArchiveRead(archive_p)
+
+
+@contextmanager
+def map_file(fd):
+    """Map a whole file into memory, read-only.
+
+    Yields `(address, length)`, the address being `None` if the file is empty
+    (empty files can't be mapped). The mapping is shared, so it isn't charged
+    against the commit limit and files larger than the memory can be mapped.
+    """
+    length = fstat(fd).st_size
+    if not length:
+        yield None, 0
+        return
+    if ffi.libc_mmap is None:  # pragma: no cover
+        raise NotImplementedError('mmap is not available on this platform')
+    address = ffi.libc_mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED,
+                            fd, 0)
+    if address in (None, ffi.MAP_FAILED):
+        e = get_errno()
+        raise OSError(e, os.strerror(e))
+    try:
+        yield address, length
+    finally:
+        ffi.libc_munmap(address, length)
+
+
+@contextmanager
+def mmap_reader(path, format_name='all', filter_name='all', options=None):
+    """Read an archive from a file by mapping it into memory.
+
+    The mapping is read-only and shared, so the pages are served straight
+    from the page cache and no read syscalls are made.
+    """
+    with open(path, 'rb') as f:
+        with map_file(f.fileno()) as (address, length):
+            with new_archive_read(format_name, filter_name, options) \
+                    as archive_p:
+                ffi.read_open_memory(archive_p, address, length)
+                yield ArchiveRead(archive_p)
+
+
+def list_entries(path, format_name='all', filter_name='all', **kwargs):
+    """Return the list of the `EntryInfo` of the entries in an archive file.
+
+    Extra keyword arguments are passed to `file_reader`.
+    """
+    with file_reader(path, format_name, filter_name, **kwargs) as archive:
+        return list(archive.iter_headers())
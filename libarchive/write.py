@@ -1,10 +1,19 @@
 from __future__ import division, print_function, unicode_literals
 
+import bz2
+from collections import deque
 from contextlib import contextmanager
-from ctypes import byref, cast, c_char, c_size_t, c_void_p, POINTER
+from ctypes import (
+    byref, cast, c_char, c_size_t, c_void_p, POINTER,
+)
+import errno
+from functools import partial
+import os
+import zlib
 
 from . import ffi
-from .entry import ArchiveEntry, new_archive_entry
+from .entry import ArchiveEntry, new_archive_entry, writable_buffer
+from .extract import cpu_count
 from .ffi import (
     OPEN_CALLBACK, WRITE_CALLBACK, CLOSE_CALLBACK, VOID_CB, REGULAR_FILE,
     DEFAULT_UNIX_PERMISSION, ARCHIVE_EOF,
@@ -12,6 +21,43 @@ from .ffi import (
     read_next_header2, read_disk_descend, read_free, write_header, write_data,
     write_finish_entry, entry_set_size, entry_set_filetype, entry_set_perm
 )
+from .read import encode_options, map_file
+
+
+HOLE_BLOCK_SIZE = 1024 * 1024
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+STORE_SAMPLE_SIZE = 64 * 1024
+
+# extensions of file formats which are already compressed
+STORED_EXTENSIONS = frozenset((
+    '.7z', '.aac', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz',
+    '.heic', '.jar', '.jpeg', '.jpg', '.lz', '.lz4', '.lzma', '.m4a', '.m4v',
+    '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.opus', '.png', '.rar',
+    '.tbz2', '.tgz', '.txz', '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip',
+    '.zst',
+))
+
+
+def _gzip_frame(data, level):
+    c = zlib.compressobj(6 if level is None else level, zlib.DEFLATED,
+                         16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def _xz_frame(data, level):
+    import lzma  # not available on Python 2
+    return lzma.compress(data, lzma.FORMAT_XZ,
+                         preset=6 if level is None else level)
+
+
+# filter name -> function compressing a chunk into one self-contained frame,
+# the concatenation of the frames being a valid stream
+FRAME_COMPRESSORS = {
+    'gzip': _gzip_frame,
+    'bzip2': lambda data, level: bz2.compress(data, level or 9),
+    'xz': _xz_frame,
+}
 
 
 @contextmanager
@@ -38,6 +84,191 @@ def new_archive_entry_from_path(path):
             yield entry
 
 
+def file_data_regions(fd, size):
+    """ return the (offset, length) data regions of a file
+
+        The holes are found with SEEK_DATA/SEEK_HOLE, None is returned if the
+        platform or filesystem doesn't support them.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return None  # pragma: no cover
+    regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # there is only a hole after offset
+                break
+            offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            regions.append((start, offset - start))
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return regions
+
+
+def set_sparse_map(entry, regions, size):
+    """ set the sparse map of an entry from its data regions, if it has holes
+    """
+    if regions == [(0, size)]:
+        return
+    ffi.entry_sparse_clear(entry.entry_p)
+    entry._sparse_map = None
+    sparse_map = entry.sparse_map
+    sparse_map.extend(regions)
+    if not regions or sum(regions[-1]) < size:
+        # mark the trailing hole, like libarchive does
+        sparse_map.append((size, 0))
+
+
+@contextmanager
+def no_mapping():
+    yield None
+
+
+def write_file_data(write_p, f, block_size, size, regions=None,
+                    mapping=None):
+    """ write the data of the file `f` as the current entry's data
+
+        The data is read into one reusable buffer, or, if a `mapping` of the
+        file is given as an `(address, length)` tuple (see `read.map_file`),
+        passed to libarchive straight from memory.
+
+        If `regions` are given only those are read, and zeros are written for
+        the holes in between without touching the disk. Only the pax writer
+        discards them (if the entry has a sparse map), the other formats
+        store the zeros.
+    """
+    for _ in iter_file_data(write_p, f, block_size, size, regions, mapping):
+        pass
+
+
+def iter_file_data(write_p, f, block_size, size, regions=None,
+                   mapping=None):
+    """ like `write_file_data`, but yield after every block """
+    if regions is None:
+        regions = [(0, size)]
+    if mapping is not None:
+        base, available = mapping
+    else:
+        view, c_buf = writable_buffer(bytearray(block_size))
+        available = size
+    zeros = b''
+    pos = 0
+    for offset, length in regions + [(size, 0)]:
+        hole = offset - pos
+        if hole > 0 and not zeros:
+            zeros = bytes(bytearray(HOLE_BLOCK_SIZE))
+        while hole > 0:
+            n = min(hole, HOLE_BLOCK_SIZE)
+            write_data(write_p, zeros, n)
+            yield
+            hole -= n
+        # the file may have shrunk since its size was read
+        end = min(offset + length, available)
+        if mapping is not None:
+            while offset < end:
+                n = min(end - offset, block_size)
+                write_data(write_p, base + offset, n)
+                yield
+                offset += n
+        else:
+            f.seek(offset)
+            while offset < end:
+                n = f.readinto(view[:min(end - offset, block_size)])
+                if not n:
+                    break
+                write_data(write_p, c_buf, n)
+                yield
+                offset += n
+        pos = max(pos, offset)
+
+
+def store_by_extension(extensions=STORED_EXTENSIONS):
+    """ return a store policy matching the files' extensions
+
+        The comparison is case-insensitive.
+    """
+    extensions = tuple(e.lower() for e in extensions)
+
+    def policy(path, read_sample):
+        return path.lower().endswith(extensions)
+
+    return policy
+
+
+def store_if_incompressible(min_ratio=0.95, level=1):
+    """ return a store policy based on the compressibility of the data
+
+        The first block of each file is compressed with zlib at the given
+        `level`, the file is considered incompressible if the result is at
+        least `min_ratio` times the size of the block.
+    """
+
+    def policy(path, read_sample):
+        sample = read_sample()
+        if not sample:
+            return False
+        return len(zlib.compress(sample, level)) >= min_ratio * len(sample)
+
+    return policy
+
+
+def zip_compression_option(paths, store_policy=None, min_fraction=0.5):
+    """ return the zip compression option suited to the files in `paths`
+
+        `store_policy(path, read_sample)` is called for every regular file and
+        should return true if compressing the file is a waste of time.
+        `read_sample()` reads and returns the first bytes of the file's data,
+        so that the files are only opened by the policies that need them.
+
+        If the files the policy matches make up at least `min_fraction` of
+        the data, `'zip:compression=store'` is returned, otherwise
+        `'zip:compression=deflate'`. The policy defaults to
+        `store_by_extension()`.
+
+        libarchive only accepts options before the archive is opened, so the
+        compression can't be chosen entry by entry.
+    """
+    if store_policy is None:
+        store_policy = store_by_extension()
+    total = stored = 0
+    for path in iter_file_paths(paths):
+        size = os.stat(path).st_size
+        if store_policy(path, partial(read_sample, path)):
+            stored += size
+        total += size
+    compression = 'store' if total and stored >= min_fraction * total \
+        else 'deflate'
+    return 'zip:compression=' + compression
+
+
+def read_sample(path, size=STORE_SAMPLE_SIZE):
+    """ return the first `size` bytes of the file at `path` """
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def iter_file_paths(paths):
+    """ yield the paths of the regular files in `paths`, recursively
+    """
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    file_path = os.path.join(dirpath, filename)
+                    if os.path.isfile(file_path) and \
+                            not os.path.islink(file_path):
+                        yield file_path
+        elif os.path.isfile(path) and not os.path.islink(path):
+            yield path
+
+
 class ArchiveWrite(object):
 
     def __init__(self, archive_p):
@@ -46,19 +277,46 @@ class ArchiveWrite(object):
     def add_entries(self, entries):
         """Add the given entries to the archive.
         """
+        for _ in self._iter_add_entries(entries):
+            pass
+
+    def _iter_add_entries(self, entries):
         write_p = self._pointer
         for entry in entries:
             write_header(write_p, entry._entry_p)
+            yield
             for block in entry.get_blocks():
                 write_data(write_p, block, len(block))
+                yield
             write_finish_entry(write_p)
 
-    def add_files(self, *paths):
+    def add_files(self, *paths, **kwargs):
         """Read the given paths from disk and add them to the archive.
+
+        The holes of sparse files are detected and not read, but only the
+        pax format stores them sparsely, the others store zeros.
+
+        Keyword arguments:
+        `block_size` is the size of the reads, it defaults to the archive's
+        bytes per block.
+        `mmap_threshold` is the size from which files are memory-mapped
+        instead of read, by default they never are. Only use it for files
+        that can't be truncated while they are archived: reading past the end
+        of a file through its mapping kills the process with SIGBUS.
         """
+        for _ in self._iter_add_files(*paths, **kwargs):
+            pass
+
+    def _iter_add_files(self, *paths, **kwargs):
         write_p = self._pointer
 
-        block_size = ffi.write_get_bytes_per_block(write_p)
+        block_size = kwargs.pop('block_size', None)
+        mmap_threshold = kwargs.pop('mmap_threshold', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                            ', '.join(kwargs))
+        if not block_size:
+            block_size = ffi.write_get_bytes_per_block(write_p)
         if block_size <= 0:
             block_size = 10240  # pragma: no cover
 
@@ -72,14 +330,29 @@ class ArchiveWrite(object):
                             break
                         entry.pathname = entry.pathname.lstrip('/')
                         read_disk_descend(read_p)
-                        write_header(write_p, entry_p)
                         if entry.isreg:
-                            with open(entry_sourcepath(entry_p), 'rb') as f:
-                                while 1:
-                                    data = f.read(block_size)
-                                    if not data:
-                                        break
-                                    write_data(write_p, data, len(data))
+                            source = entry_sourcepath(entry_p)
+                            with open(source, 'rb', buffering=0) as f:
+                                size = entry.size
+                                regions = file_data_regions(f.fileno(), size)
+                                if regions is not None:
+                                    set_sparse_map(entry, regions, size)
+                                use_mmap = mmap_threshold is not None and \
+                                    size >= mmap_threshold
+                                # map before the header is written, so that
+                                # a failure doesn't leave a truncated entry
+                                with (map_file(f.fileno()) if use_mmap
+                                      else no_mapping()) as mapping:
+                                    write_header(write_p, entry_p)
+                                    yield
+                                    for _ in iter_file_data(
+                                        write_p, f, block_size, size, regions,
+                                        mapping
+                                    ):
+                                        yield
+                        else:
+                            write_header(write_p, entry_p)
+                            yield
                         write_finish_entry(write_p)
                         entry_clear(entry_p)
 
@@ -102,6 +375,14 @@ class ArchiveWrite(object):
         :param permission: with which permission should entry be created
         :type permission: octal number
         """
+        for _ in self._iter_add_file_from_memory(
+            entry_path, entry_size, entry_data, filetype, permission
+        ):
+            pass
+
+    def _iter_add_file_from_memory(
+            self, entry_path, entry_size, entry_data, filetype, permission
+    ):
         archive_pointer = self._pointer
 
         with new_archive_entry() as archive_entry_pointer:
@@ -112,22 +393,37 @@ class ArchiveWrite(object):
             entry_set_filetype(archive_entry_pointer, filetype)
             entry_set_perm(archive_entry_pointer, permission)
             write_header(archive_pointer, archive_entry_pointer)
+            yield
 
             for chunk in entry_data:
                 if not chunk:
                     break
                 write_data(archive_pointer, chunk, len(chunk))
+                yield
 
             write_finish_entry(archive_pointer)
             entry_clear(archive_entry_pointer)
 
 
 @contextmanager
-def new_archive_write(format_name, filter_name=None):
+def new_archive_write(format_name, filter_name=None, options=None):
+    """ create an archive struct suitable for writing
+
+        `options` is a string of comma-separated libarchive options, e.g.
+        `'zstd:threads=8,zstd:compression-level=19'` or
+        `'zip:compression=store'`, see the archive_write_set_options(3)
+        manpage.
+    """
     archive_p = ffi.write_new()
-    getattr(ffi, 'write_set_format_'+format_name)(archive_p)
-    if filter_name:
-        getattr(ffi, 'write_add_filter_'+filter_name)(archive_p)
+    try:
+        getattr(ffi, 'write_set_format_'+format_name)(archive_p)
+        if filter_name:
+            getattr(ffi, 'write_add_filter_'+filter_name)(archive_p)
+        if options:
+            ffi.write_set_options(archive_p, encode_options(options))
+    except BaseException:
+        ffi.write_free(archive_p)
+        raise
     try:
         yield archive_p
         ffi.write_close(archive_p)
@@ -142,7 +438,7 @@ def new_archive_write(format_name, filter_name=None):
 def custom_writer(
         write_func, format_name, filter_name=None,
         open_func=VOID_CB, close_func=VOID_CB, block_size=page_size,
-        archive_write_class=ArchiveWrite
+        archive_write_class=ArchiveWrite, options=None
 ):
 
     def write_cb_internal(archive_p, context, buffer_, length):
@@ -153,7 +449,7 @@ def custom_writer(
     write_cb = WRITE_CALLBACK(write_cb_internal)
     close_cb = CLOSE_CALLBACK(close_func)
 
-    with new_archive_write(format_name, filter_name) as archive_p:
+    with new_archive_write(format_name, filter_name, options) as archive_p:
         ffi.write_set_bytes_in_last_block(archive_p, 1)
         ffi.write_set_bytes_per_block(archive_p, block_size)
         ffi.write_open(archive_p, None, open_cb, write_cb, close_cb)
@@ -162,9 +458,10 @@ def custom_writer(
 
 @contextmanager
 def fd_writer(
-        fd, format_name, filter_name=None, archive_write_class=ArchiveWrite
+        fd, format_name, filter_name=None, archive_write_class=ArchiveWrite,
+        options=None
 ):
-    with new_archive_write(format_name, filter_name) as archive_p:
+    with new_archive_write(format_name, filter_name, options) as archive_p:
         ffi.write_open_fd(archive_p, fd)
         yield archive_write_class(archive_p)
 
@@ -172,19 +469,125 @@ def fd_writer(
 @contextmanager
 def file_writer(
         filepath, format_name, filter_name=None,
-        archive_write_class=ArchiveWrite
+        archive_write_class=ArchiveWrite, options=None
 ):
-    with new_archive_write(format_name, filter_name) as archive_p:
+    with new_archive_write(format_name, filter_name, options) as archive_p:
         ffi.write_open_filename_w(archive_p, filepath)
         yield archive_write_class(archive_p)
 
 
 @contextmanager
 def memory_writer(
-        buf, format_name, filter_name=None, archive_write_class=ArchiveWrite
+        buf, format_name, filter_name=None, archive_write_class=ArchiveWrite,
+        options=None
 ):
-    with new_archive_write(format_name, filter_name) as archive_p:
+    with new_archive_write(format_name, filter_name, options) as archive_p:
         used = byref(c_size_t())
         buf_p = cast(buf, c_void_p)
         ffi.write_open_memory(archive_p, buf_p, len(buf), used)
         yield archive_write_class(archive_p)
+
+
+@contextmanager
+def parallel_writer(
+        write_func, format_name, filter_name='gzip', workers=None,
+        chunk_size=PARALLEL_CHUNK_SIZE, compression_level=None,
+        archive_write_class=ArchiveWrite, options=None
+):
+    """ like `custom_writer`, but compress on a pool of threads
+
+        The uncompressed archive is cut into chunks of `chunk_size` bytes,
+        which are compressed in parallel as independent frames (gzip members,
+        bzip2 or xz streams) and passed to `write_func` in order. Any
+        decompressor reads the result like a single stream. `options` are
+        passed to the format writer, the compression level is set by
+        `compression_level`.
+    """
+    try:
+        compress = FRAME_COMPRESSORS[filter_name]
+    except KeyError:
+        raise ValueError('%r does not support parallel compression, use one '
+                         'of %s' % (filter_name, ', '.join(FRAME_COMPRESSORS)))
+    from concurrent.futures import ThreadPoolExecutor
+
+    if workers is None:
+        workers = cpu_count()
+    buf = bytearray()
+    pending = deque()
+
+    with ThreadPoolExecutor(workers) as executor:
+
+        def submit(data):
+            pending.append(executor.submit(compress, data, compression_level))
+            # bound the memory used by waiting for the oldest frame
+            while len(pending) > 2 * workers:
+                write_func(pending.popleft().result())
+
+        def write(data):
+            buf.extend(data)
+            if len(buf) >= chunk_size:
+                submit(bytes(buf))
+                del buf[:]
+            return len(data)
+
+        try:
+            with custom_writer(write, format_name,
+                               archive_write_class=archive_write_class,
+                               options=options) as archive:
+                yield archive
+            if buf:
+                submit(bytes(buf))
+            while pending:
+                write_func(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+@contextmanager
+def parallel_file_writer(filepath, format_name, filter_name='gzip', **kw):
+    """ like `file_writer`, but compress on a pool of threads
+
+        See `parallel_writer` for the keyword arguments.
+    """
+    with open(filepath, 'wb') as f:
+        with parallel_writer(f.write, format_name, filter_name, **kw) \
+                as archive:
+            yield archive
+
+
+def stream_archive(entries, format_name, filter_name=None,
+                   chunk_size=STREAM_CHUNK_SIZE, options=None):
+    """ generate an archive as an iterator of `bytes` chunks
+
+        `entries` is an iterable of paths, which are added like `add_files`
+        does, and of `ArchiveEntry` objects (e.g. from a reader), which are
+        added like `add_entries` does.
+
+        The archive is written step by step as the chunks are consumed, so
+        only a few chunks of about `chunk_size` bytes are held in memory,
+        whatever the size of the entries. This is suitable for the body of a
+        streaming HTTP response. If the iterator is closed before the end the
+        archive is abandoned.
+    """
+    chunks = []
+
+    def write(data):
+        chunks.append(bytes(data))
+        return len(data)
+
+    with custom_writer(write, format_name, filter_name,
+                       block_size=chunk_size, options=options) as archive:
+        for item in entries:
+            if hasattr(item, 'get_blocks'):
+                steps = archive._iter_add_entries([item])
+            else:
+                steps = archive._iter_add_files(item)
+            for _ in steps:
+                if chunks:
+                    for chunk in chunks:
+                        yield chunk
+                    del chunks[:]
+    # closing the archive flushes the remaining data
+    for chunk in chunks:
+        yield chunk
@@ -0,0 +1,12 @@
+from __future__ import division, print_function, unicode_literals
+
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # the asyncio front-ends use syntax older versions can't parse
+    collect_ignore.append('test_aio.py')
+if sys.version_info < (3,):
+    # libarchive.checkpoint needs lzma, libarchive.index array('q')
+    collect_ignore.extend(['test_checkpoint.py', 'test_index.py'])
@@ -0,0 +1,110 @@
+"""Test the asyncio front-ends."""
+
+from __future__ import division, print_function, unicode_literals
+
+import asyncio
+import io
+
+import pytest
+
+import libarchive
+from libarchive import aio
+
+from . import check_archive, treestat
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_file_writer_and_reader(tmpdir):
+    tree = treestat('libarchive')
+    path = str(tmpdir / 'test.tar.gz')
+
+    async def main():
+        async with aio.file_writer(path, 'gnutar', 'gzip') as archive:
+            await archive.add_files('libarchive/')
+        contents = {}
+        async with aio.file_reader(path) as archive:
+            async for entry in archive:
+                if entry.isreg:
+                    contents[entry.pathname] = await entry.read()
+        return contents
+
+    contents = run(main())
+    with open('libarchive/__init__.py', 'rb') as f:
+        assert contents['libarchive/__init__.py'] == f.read()
+    with libarchive.file_reader(path) as archive:
+        check_archive(archive, tree)
+
+
+def test_stream_writer_and_reader():
+    tree = treestat('libarchive')
+
+    async def main():
+        out = io.BytesIO()
+
+        async def write(data):
+            await asyncio.sleep(0)
+            out.write(data)
+
+        async with aio.stream_writer(write, 'gnutar', 'xz', queue_size=2) \
+                as archive:
+            await archive.add_files('libarchive/')
+        data = out.getvalue()
+
+        stream = io.BytesIO(data)
+
+        async def read(n):
+            await asyncio.sleep(0)
+            return stream.read(n)
+
+        blocks = []
+        async with aio.stream_reader(read, block_size=1000) as archive:
+            async for entry in archive:
+                if entry.pathname == 'libarchive/__init__.py':
+                    async for block in entry.get_blocks(100):
+                        blocks.append(block)
+        return data, b''.join(blocks)
+
+    data, init = run(main())
+    with libarchive.memory_reader(data) as archive:
+        check_archive(archive, tree)
+    with open('libarchive/__init__.py', 'rb') as f:
+        assert init == f.read()
+
+
+def test_partial_reads():
+
+    async def main():
+        buf = bytes(bytearray(10000))
+        async with aio.memory_writer(buf, 'ustar') as archive:
+            await archive.add_file_from_memory('a', 10, [b'0123456789'])
+        async with aio.memory_reader(buf) as archive:
+            async for entry in archive:
+                return await entry.read(4), await entry.read(100)
+
+    assert run(main()) == (b'0123', b'456789')
+
+
+def test_stream_errors():
+
+    class Boom(Exception):
+        pass
+
+    async def fail(*args):
+        raise Boom()
+
+    async def write_then_fail():
+        async with aio.stream_writer(fail, 'gnutar') as archive:
+            await archive.add_files('libarchive/')
+
+    async def read_then_fail():
+        async with aio.stream_reader(fail) as archive:
+            async for entry in archive:
+                pass
+
+    with pytest.raises(Boom):
+        run(write_then_fail())
+    with pytest.raises(Boom):
+        run(read_then_fail())
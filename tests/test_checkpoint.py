@@ -0,0 +1,81 @@
+from __future__ import division, print_function, unicode_literals
+
+import gzip
+import io
+import lzma
+from shutil import which
+import subprocess
+
+import pytest
+
+from libarchive import file_writer
+from libarchive.checkpoint import (
+    OUTPUT_LIMIT, iter_frames, open_compressed_member, scan_checkpoints,
+    write_checkpoints,
+)
+
+
+def compress_in_frames(data, compress, frame_size):
+    return b''.join(compress(data[i:i + frame_size])
+                    for i in range(0, len(data), frame_size))
+
+
+def zstd_compress(data):
+    return subprocess.check_output(['zstd', '-q', '-c'], input=data)
+
+
+def zstd_compress_with_size(data):
+    return subprocess.check_output(
+        ['zstd', '-q', '-c', '--stream-size=%i' % len(data)], input=data
+    )
+
+
+zstd_compressors = [
+    pytest.param(c, marks=pytest.mark.skipif(
+        which('zstd') is None, reason='the zstd command is not installed'
+    ))
+    for c in (zstd_compress, zstd_compress_with_size)
+]
+
+
+@pytest.mark.parametrize(
+    'compress', [gzip.compress, lzma.compress] + zstd_compressors
+)
+@pytest.mark.parametrize('frame_size', [5000, 10 ** 9])
+def test_checkpoints(tmpdir, compress, frame_size):
+    tar_path = tmpdir.strpath+'/test.tar'
+    with file_writer(tar_path, 'pax') as archive:
+        archive.add_files('libarchive/', 'README.rst')
+    with open(tar_path, 'rb') as f:
+        tar_data = f.read()
+
+    archive_path = tar_path + '.z'
+    with open(archive_path, 'wb') as f:
+        f.write(compress_in_frames(tar_data, compress, frame_size))
+
+    checkpoints, index = write_checkpoints(archive_path)
+    with open(archive_path, 'rb') as f:
+        assert scan_checkpoints(f) == checkpoints
+    assert len(checkpoints) == -(-len(tar_data) // frame_size)
+    assert [u for c, u in checkpoints] == list(
+        range(0, len(tar_data), frame_size)
+    )
+
+    for name in ('README.rst', 'libarchive/entry.py', 'libarchive/ffi.py'):
+        with open(name, 'rb') as f:
+            expected = f.read()
+        with open_compressed_member(archive_path, name) as entry:
+            assert entry.pathname == name
+            assert b''.join(entry.get_blocks()) == expected
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, lzma.compress])
+def test_scan_memory_is_bounded(compress):
+    data = compress_in_frames(bytes(50 * 1024 * 1024), compress, 30 * 2 ** 20)
+    checkpoints = []
+    chunks = iter_frames(io.BytesIO(data), checkpoints)
+    sizes = [len(chunk) for chunk in chunks]
+    assert max(sizes) <= OUTPUT_LIMIT
+    assert sum(sizes) == 50 * 1024 * 1024
+    assert checkpoints == scan_checkpoints(io.BytesIO(data))
+    assert [u for c, u in checkpoints] == [0, 30 * 2 ** 20]
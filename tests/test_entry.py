@@ -3,14 +3,19 @@
 from __future__ import division, print_function, unicode_literals
 
 from codecs import open
+from io import BufferedReader, BytesIO
 import json
 import locale
+import os
 from os import environ, stat
 from os.path import join
+import pickle
+import shutil
 
 import pytest
 
 from libarchive import memory_reader, memory_writer, file_reader, ffi
+from libarchive.extract import write_data_to_fd
 from libarchive.write import new_archive_entry_from_path
 
 from . import (data_dir, get_entries, get_tarinfos, generate_contents,
@@ -194,3 +199,154 @@ def check_entries(test_file, regen=False, ignore=''):
             e1.pop(key)
             e2.pop(key)
         assert e1 == e2
+
+
+def test_entry_iter_data_blocks():
+    buf = bytes(bytearray(1000000))
+    with memory_writer(buf, 'gnutar', 'gzip') as archive:
+        archive.add_files('README.rst')
+
+    with open('README.rst', 'rb') as f:
+        expected = f.read()
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            data = bytearray()
+            for offset, view in entry.iter_data_blocks():
+                assert offset == len(data)
+                data.extend(view)
+            assert bytes(data) == expected
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            data = b''.join(bytes(v) for v in entry.get_blocks_view())
+            assert data == expected
+
+
+def test_entry_readinto():
+    buf = bytes(bytearray(1000000))
+    with memory_writer(buf, 'gnutar') as archive:
+        archive.add_files('README.rst')
+
+    with open('README.rst', 'rb') as f:
+        expected = f.read()
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            data = bytearray()
+            chunk = bytearray(100)
+            while 1:
+                n = entry.readinto(chunk)
+                if not n:
+                    break
+                data.extend(chunk[:n])
+            assert bytes(data) == expected
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            chunk = bytearray(100)
+            blocks = [bytes(b) for b in entry.get_blocks(buffer=chunk)]
+            assert max(len(b) for b in blocks) == 100
+            assert b''.join(blocks) == expected
+
+
+def test_entry_open():
+    buf = bytes(bytearray(1000000))
+    with memory_writer(buf, 'gnutar') as archive:
+        archive.add_files('README.rst')
+
+    with open('README.rst', 'rb') as f:
+        expected = f.read()
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            with entry.open() as stream:
+                assert stream.readable()
+                assert not stream.seekable()
+                out = BytesIO()
+                shutil.copyfileobj(stream, out)
+            assert out.getvalue() == expected
+            with pytest.raises(ValueError):
+                stream.read()
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            reader = BufferedReader(entry.open())
+            assert reader.readline() == expected.splitlines(True)[0]
+            assert reader.read(10) == expected.splitlines(True)[1][:10]
+
+
+def test_entry_snapshot():
+    attrs = ('pathname', 'linkpath', 'islnk', 'size', 'mode', 'filetype',
+             'uid', 'gid', 'atime', 'mtime', 'ctime', 'rdevmajor',
+             'rdevminor', 'isblk', 'ischr', 'isdir', 'isfifo', 'issym',
+             'isreg', 'isfile', 'issock', 'isdev', 'path', 'name')
+    for name in ('special.tar', 'tar_relative.tar'):
+        path = join(data_dir, name)
+        snapshots = []
+        expected = []
+        with file_reader(path) as arch:
+            for entry in arch:
+                snapshots.append(entry.snapshot())
+                expected.append(tuple(getattr(entry, a) for a in attrs))
+        actual = [tuple(getattr(s, a) for a in attrs) for s in snapshots]
+        assert actual == expected
+        assert pickle.loads(pickle.dumps(snapshots)) == snapshots
+        with pytest.raises(AttributeError):
+            snapshots[0].pathname = 'foo'
+
+
+@pytest.mark.parametrize('skip_zeros', [False, True])
+def test_write_data_to_fd(tmpdir, skip_zeros):
+    path = join(data_dir, 'testtar.tar')
+
+    outputs = {}
+    with file_reader(path) as arch:
+        for entry in arch:
+            if not entry.name.startswith('gnu/sparse'):
+                continue
+            out = tmpdir.join('out%i' % len(outputs)).strpath
+            outputs[entry.name] = out
+            fd = os.open(out, os.O_RDWR | os.O_CREAT)
+            try:
+                # existing content doesn't show through the holes
+                os.write(fd, b'\xff' * 100000)
+                written = write_data_to_fd(entry, fd, skip_zeros)
+                assert written == sum(l for o, l in entry.sparse_map)
+                assert os.fstat(fd).st_size == entry.size
+            finally:
+                os.close(fd)
+
+    assert outputs
+    with file_reader(path) as arch:
+        for entry in arch:
+            if entry.name in outputs:
+                # archive_read_data doesn't return the trailing hole
+                expected = b''.join(entry.get_blocks())
+                expected += b'\0' * (entry.size - len(expected))
+                with open(outputs[entry.name], 'rb') as f:
+                    assert f.read() == expected
+
+
+@pytest.mark.parametrize('archfmt', ['pax', 'zip'])
+def test_add_files_sparse(tmpdir, archfmt):
+    """ Holes are detected when archiving, and restored as zeros """
+    fname = tmpdir.join('sparse').strpath
+    size = 4 * 1024 * 1024
+    write_map = [(1024 * 1024, 4096), (3 * 1024 * 1024, 4096)]
+    create_sparse_file(fname, write_map, size)
+    with open(fname, 'rb') as f:
+        expected = f.read()
+
+    buf = bytes(bytearray(1000000))
+    with memory_writer(buf, archfmt) as archive:
+        archive.add_files(fname)
+
+    with memory_reader(buf) as archive:
+        for entry in archive:
+            assert entry.size == size
+            if archfmt == 'pax':
+                assert entry.sparse_map == write_map + [(size, 0)]
+            data = b''.join(entry.get_blocks())
+            data += b'\0' * (size - len(data))
+            assert data == expected
@@ -0,0 +1,72 @@
+from __future__ import division, print_function, unicode_literals
+
+from stat import S_IFDIR, S_IFREG
+
+import pytest
+
+from libarchive import (
+    file_writer, file_reader, index, memory_reader, memory_writer,
+)
+
+from . import treestat
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_build_index(tmpdir, monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(index, 'numpy', None)
+    elif index.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    archive_path = tmpdir.strpath+'/test.tar'
+    tree = treestat('libarchive')
+    with file_writer(archive_path, 'pax') as archive:
+        archive.add_files('libarchive/', 'README.rst')
+
+    with file_reader(archive_path) as archive:
+        idx = index.build_index(archive)
+
+    assert len(idx) == len(tree) + 1
+    paths = idx.pathnames()
+    for i, path in enumerate(paths):
+        if path == 'README.rst':
+            continue
+        estat = tree[path.rstrip('/')]
+        assert idx.mtimes[i] == estat['mtime']
+        if 'size' in estat:
+            assert idx.sizes[i] == estat['size']
+
+    def select(**kw):
+        return sorted(paths[i] for i in idx.select(**kw))
+
+    py_files = select(extensions=['.py'])
+    assert py_files == sorted(p for p in paths if p.endswith('.py'))
+    assert select(extensions=['.py', '.rst']) == sorted(
+        py_files + ['README.rst']
+    )
+    assert select(extensions=['.nothing']) == []
+    assert select(filetype=S_IFDIR) == ['libarchive/']
+    assert len(select(filetype=S_IFREG)) == len(paths) - 1
+
+    sizes = dict((p, idx.sizes[i]) for i, p in enumerate(paths))
+    small = select(filetype=S_IFREG, max_size=2000)
+    assert small == sorted(p for p in py_files + ['README.rst']
+                           if sizes[p] <= 2000)
+    assert select(min_size=2001, extensions=['.py']) == sorted(
+        p for p in py_files if sizes[p] >= 2001
+    )
+
+
+def test_index_pathnames():
+    # the pathnames are the same as those of the entries
+    buf = bytes(bytearray(100000))
+    with memory_writer(buf, 'pax') as archive:
+        for name in ('caf\xe9.txt', 'd\xfcr/\u65e5\u672c.txt'):
+            archive.add_file_from_memory(name, 3, [b'abc'])
+
+    with memory_reader(buf) as archive:
+        expected = [entry.pathname for entry in archive]
+    with memory_reader(buf) as archive:
+        idx = index.build_index(archive)
+    assert idx.pathnames() == expected
+    assert expected == ['caf\xe9.txt', 'd\xfcr/\u65e5\u672c.txt']
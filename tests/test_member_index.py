@@ -0,0 +1,53 @@
+from __future__ import division, print_function, unicode_literals
+
+from os.path import exists
+
+import pytest
+
+from libarchive import ArchiveError, file_writer
+from libarchive.member_index import (
+    MemberIndex, index_path, open_member, write_member_index
+)
+
+
+def test_member_index(tmpdir):
+    archive_path = tmpdir.strpath+'/test.tar'
+    with file_writer(archive_path, 'pax') as archive:
+        archive.add_files('libarchive/', 'README.rst')
+
+    index = write_member_index(archive_path)
+    assert exists(index_path(archive_path))
+    assert MemberIndex.load(index_path(archive_path)) == index
+
+    with open(archive_path, 'rb') as f:
+        archive_data = f.read()
+    for name in ('README.rst', 'libarchive/entry.py'):
+        with open(name, 'rb') as f:
+            expected = f.read()
+        loc = index[name]
+        assert loc.size == len(expected)
+        start = loc.data_offset
+        assert archive_data[start:start + loc.size] == expected
+        with open_member(archive_path, name) as entry:
+            assert entry.pathname == name
+            assert b''.join(entry.get_blocks()) == expected
+
+    with pytest.raises(KeyError):
+        with open_member(archive_path, 'nonexistent', index):
+            pass
+
+    # the index is stale after the archive is rewritten
+    with file_writer(archive_path, 'pax') as archive:
+        archive.add_files('README.rst', 'libarchive/')
+    with pytest.raises(ArchiveError):
+        with open_member(archive_path, 'README.rst', index):
+            pass
+
+
+def test_member_index_compressed(tmpdir):
+    archive_path = tmpdir.strpath+'/test.tar.gz'
+    with file_writer(archive_path, 'pax', 'gzip') as archive:
+        archive.add_files('README.rst')
+
+    with pytest.raises(ArchiveError):
+        write_member_index(archive_path)
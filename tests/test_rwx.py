@@ -1,12 +1,28 @@
 """Test reading, writing and extracting archives."""
 
 from __future__ import division, print_function, unicode_literals
+from ctypes import string_at
+import errno
 import io
+import os
+import re
+import tarfile
+import time
+import zipfile
 
 import libarchive
-from libarchive.extract import EXTRACT_OWNER, EXTRACT_PERM, EXTRACT_TIME
-from libarchive.write import memory_writer
+from libarchive.extract import (
+    EXTRACT_NO_OVERWRITE, EXTRACT_NO_OVERWRITE_NEWER, EXTRACT_OWNER,
+    EXTRACT_PERM, EXTRACT_SECURE_NOABSOLUTEPATHS, EXTRACT_TIME, extract_entries,
+    extract_entries_pipelined, extract_file,
+    filter_entries,
+)
+from libarchive.read import AUTO_BLOCK_SIZE, get_block_size, map_file
+from libarchive.write import (
+    memory_writer, store_if_incompressible, zip_compression_option,
+)
 from mock import patch
+import pytest
 
 from . import check_archive, in_dir, treestat
 
@@ -146,3 +162,673 @@ def test_adding_entry_from_memory():
                 archive_entry.get_blocks()
             )
             assert archive_entry.path == entry_path
+
+
+def test_custom_seek_skip():
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    blocks = []
+
+    def write_cb(data):
+        blocks.append(data[:])
+        return len(data)
+
+    with libarchive.custom_writer(write_cb, 'zip') as archive:
+        archive.add_files('libarchive/')
+
+    reader = io.BytesIO(b''.join(blocks))
+    calls = []
+
+    def seek(offset, whence):
+        calls.append('seek')
+        return reader.seek(offset, whence)
+
+    def skip(request):
+        calls.append('skip')
+        start = reader.tell()
+        return reader.seek(request, io.SEEK_CUR) - start
+
+    with libarchive.custom_reader(
+        reader.readinto, 'zip', seek_func=seek, skip_func=skip
+    ) as archive:
+        check_archive(archive, tree)
+    assert 'seek' in calls
+
+
+def test_custom_zero_copy():
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar', 'gzip') as archive:
+        archive.add_files('libarchive/')
+
+    # hand out a mix of bytes and writable memoryviews
+    chunks = [buf[i:i + 65536] for i in range(0, len(buf), 65536)]
+    chunks = [c if i % 2 else memoryview(bytearray(c))
+              for i, c in enumerate(chunks)]
+    chunks = iter(chunks)
+
+    def read():
+        return next(chunks, b'')
+
+    with libarchive.custom_reader(read, 'all', zero_copy=True) as archive:
+        check_archive(archive, tree)
+
+
+def test_mmap(tmpdir):
+    archive_path = tmpdir.strpath+'/test.tar.gz'
+
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    # Create an archive of our libarchive/ directory
+    with libarchive.file_writer(archive_path, 'ustar', 'gzip') as archive:
+        archive.add_files('libarchive/')
+
+    # Read the archive and check that the data is correct
+    with libarchive.mmap_reader(archive_path) as archive:
+        check_archive(archive, tree)
+
+    # The file is mapped read-only, in place
+    with open(archive_path, 'rb') as f:
+        with map_file(f.fileno()) as (address, length):
+            assert string_at(address, length) == f.read()
+
+    # An empty file is an empty archive
+    empty_path = tmpdir.strpath+'/empty'
+    open(empty_path, 'wb').close()
+    with libarchive.mmap_reader(empty_path, 'empty') as archive:
+        assert list(archive) == []
+
+
+def test_reader_block_size(tmpdir):
+    archive_path = tmpdir.strpath+'/test.tar'
+    with libarchive.file_writer(archive_path, 'ustar') as archive:
+        archive.add_files('libarchive/')
+
+    blksize = os.stat(archive_path).st_blksize
+    assert get_block_size(os.stat, archive_path) == blksize
+    assert get_block_size(os.stat, archive_path, 12345) == 12345
+    auto = get_block_size(os.stat, archive_path, 'auto')
+    assert auto % blksize == 0
+    assert auto >= min(os.stat(archive_path).st_size, AUTO_BLOCK_SIZE)
+
+    with patch('libarchive.ffi.read_open_filename_w',
+               wraps=libarchive.ffi.read_open_filename_w) as open_mock:
+        with libarchive.file_reader(archive_path, block_size=65536) as a:
+            assert len(list(a)) > 0
+        assert open_mock.call_args[0][2] == 65536
+
+    tree = treestat('libarchive')
+    with patch('libarchive.ffi.read_open_fd',
+               wraps=libarchive.ffi.read_open_fd) as open_mock:
+        with libarchive.file_reader(archive_path, block_size='auto',
+                                    sequential=True) as archive:
+            check_archive(archive, tree)
+        assert open_mock.call_args[0][2] == auto
+
+    # pipes can't be advised, and get large blocks
+    r, w = os.pipe()
+    try:
+        assert get_block_size(os.fstat, r, 'auto') == AUTO_BLOCK_SIZE
+        os.close(w)
+        with libarchive.fd_reader(r, sequential=True) as archive:
+            assert list(archive) == []
+    finally:
+        os.close(r)
+
+
+def test_list_entries(tmpdir):
+    archive_path = tmpdir.strpath+'/test.zip'
+
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    with libarchive.file_writer(archive_path, 'zip') as archive:
+        archive.add_files('libarchive/')
+
+    infos = libarchive.list_entries(archive_path)
+    assert len(infos) == len(tree)
+    for info in infos:
+        estat = tree[info.pathname.rstrip('/')]
+        assert info.mtime == estat['mtime']
+        if 'size' in estat:
+            assert info.size == estat['size']
+        with pytest.raises(AttributeError):
+            info.size = 0
+
+
+def test_extract_many(tmpdir):
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    paths, dest_dirs = [], []
+    for i, (fmt, filt) in enumerate([('ustar', 'gzip'), ('zip', None),
+                                     ('pax', 'xz')]):
+        path = tmpdir.strpath+'/test%i' % i
+        with libarchive.file_writer(path, fmt, filt) as archive:
+            archive.add_files('libarchive/')
+        paths.append(path)
+        dest_dirs.append(tmpdir.mkdir('dest%i' % i).strpath)
+    paths.append(tmpdir.strpath+'/nonexistent')
+    dest_dirs.append(tmpdir.strpath)
+
+    calls = []
+    flags = EXTRACT_OWNER | EXTRACT_PERM | EXTRACT_TIME
+    results = libarchive.extract_many(
+        paths, dest_dirs, flags, workers=2, max_pending=1,
+        progress=lambda result, done: calls.append(done)
+    )
+    assert calls == [1, 2, 3, 4]
+    assert [r.path for r in results] == paths
+    for result in results[:-1]:
+        assert result.error is None
+        with in_dir(result.dest_dir):
+            assert treestat('libarchive') == tree
+    assert isinstance(results[-1].error, libarchive.ArchiveError)
+
+
+def test_extract_pipelined(tmpdir):
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar', 'xz') as archive:
+        archive.add_files('libarchive/')
+
+    # Extract the archive in tmpdir and check that the data is intact
+    with in_dir(tmpdir.strpath):
+        flags = EXTRACT_OWNER | EXTRACT_PERM | EXTRACT_TIME
+        with libarchive.memory_reader(buf) as archive:
+            extract_entries_pipelined(archive, flags, writers=3,
+                                      queue_size=2)
+        tree2 = treestat('libarchive')
+        assert tree2 == tree
+        with libarchive.memory_reader(buf) as archive:
+            for entry in archive:
+                if entry.isreg:
+                    with open(entry.pathname, 'rb') as f:
+                        assert f.read() == b''.join(entry.get_blocks())
+
+
+def test_extract_pipelined_duplicates(tmpdir):
+    # the last version of a member wins, even if writing the previous one is
+    # slower
+    tar_path = tmpdir.strpath+'/dup.tar'
+    with tarfile.open(tar_path, 'w') as tar:
+        for data in (b'a' * 2 * 1024 * 1024, b'b' * 1000):
+            info = tarfile.TarInfo('f')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        info = tarfile.TarInfo('l')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo('l')
+        info.size = 3000
+        tar.addfile(info, io.BytesIO(b'c' * 3000))
+        info = tarfile.TarInfo('l')
+        info.type = tarfile.SYMTYPE
+        info.linkname = 'f'
+        tar.addfile(info)
+
+    pwrite = os.pwrite
+
+    def slow_pwrite(fd, data, offset):
+        if len(data) > 1000:
+            time.sleep(0.01)
+        return pwrite(fd, data, offset)
+
+    with in_dir(tmpdir.strpath):
+        with patch('os.pwrite', slow_pwrite):
+            with libarchive.file_reader(tar_path) as archive:
+                extract_entries_pipelined(archive, writers=4)
+        with open('f', 'rb') as f:
+            assert f.read() == b'b' * 1000
+        assert os.readlink('l') == 'f'
+
+
+def test_extract_pipelined_flags(tmpdir):
+    tar_path = tmpdir.strpath+'/test.tar'
+    with libarchive.file_writer(tar_path, 'ustar') as archive:
+        archive.add_files('README.rst')
+    with open('README.rst', 'rb') as f:
+        readme = f.read()
+
+    with in_dir(tmpdir.strpath):
+        # a newer file is kept
+        with open('README.rst', 'w') as f:
+            f.write('newer')
+        with libarchive.file_reader(tar_path) as archive:
+            extract_entries_pipelined(archive, EXTRACT_NO_OVERWRITE_NEWER)
+        with open('README.rst') as f:
+            assert f.read() == 'newer'
+        os.unlink('README.rst')
+
+        # failing to set the owner only logs a warning, like libarchive
+        fchown_error = OSError(errno.EPERM, 'Operation not permitted')
+        with patch('os.fchown', side_effect=fchown_error):
+            with libarchive.file_reader(tar_path) as archive:
+                extract_entries_pipelined(archive, EXTRACT_OWNER)
+        with open('README.rst', 'rb') as f:
+            assert f.read() == readme
+
+
+@pytest.mark.parametrize('extract', [
+    extract_entries, extract_entries_pipelined
+])
+def test_extract_symlink_over_parent(tmpdir, extract):
+    # a symlink replacing the parent directory of a file that is still being
+    # written must be refused, not followed
+    outside = tmpdir.mkdir('outside')
+    tar_path = tmpdir.strpath+'/test.tar'
+    with tarfile.open(tar_path, 'w') as tar:
+        for name, size in (('big', 2 * 1024 * 1024), ('a/b', 3)):
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, io.BytesIO(b'x' * size))
+        info = tarfile.TarInfo('a')
+        info.type = tarfile.SYMTYPE
+        info.linkname = outside.strpath
+        tar.addfile(info)
+
+    pwrite = os.pwrite
+
+    def slow_pwrite(fd, data, offset):
+        time.sleep(0.01)
+        return pwrite(fd, data, offset)
+
+    dest = tmpdir.mkdir('dest')
+    kwargs = {} if extract is extract_entries else {'writers': 1}
+    with patch('os.pwrite', slow_pwrite):
+        with libarchive.file_reader(tar_path) as archive:
+            with pytest.raises(libarchive.ArchiveError):
+                extract(archive, dest=dest.strpath, **kwargs)
+    assert outside.listdir() == []
+    assert dest.join('a', 'b').read() == 'xxx'
+
+
+@pytest.mark.parametrize('extract', [
+    extract_entries, extract_entries_pipelined
+])
+def test_extract_no_overwrite(tmpdir, extract):
+    # existing files are skipped with a warning, the other entries extracted
+    tar_path = tmpdir.strpath+'/test.tar'
+    with tarfile.open(tar_path, 'w') as tar:
+        for name in ('f', 'g'):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b'abc'))
+
+    dest = tmpdir.mkdir('dest')
+    dest.join('f').write('old')
+    with libarchive.file_reader(tar_path) as archive:
+        extract(archive, EXTRACT_NO_OVERWRITE, dest=dest.strpath)
+    assert dest.join('f').read() == 'old'
+    assert dest.join('g').read() == 'abc'
+
+
+def test_extract_selected(tmpdir):
+    archive_path = tmpdir.strpath+'/test.tar.gz'
+    with libarchive.file_writer(archive_path, 'ustar', 'gzip') as archive:
+        archive.add_files('libarchive/', 'README.rst')
+
+    def extracted(dirname, **filters):
+        dest = tmpdir.mkdir(dirname)
+        with in_dir(dest.strpath):
+            libarchive.extract_file(archive_path, **filters)
+            return sorted(treestat('.'))
+
+    assert extracted('all') == sorted(
+        ['.', './README.rst'] + ['./' + p for p in treestat('libarchive')]
+    )
+    assert extracted('members', members=['README.rst']) == [
+        '.', './README.rst'
+    ]
+    assert extracted('include', include='*/e*.py', exclude=re.compile('x')) \
+        == ['.', './libarchive', './libarchive/entry.py']
+    assert extracted('callable', include=lambda e: e.isdir) == [
+        '.', './libarchive'
+    ]
+
+    # stop reading once all the members have been found
+    seen = []
+
+    def entries():
+        with libarchive.file_reader(archive_path) as archive:
+            for entry in archive:
+                seen.append(entry.pathname)
+                yield entry
+
+    selected = [e.pathname for e in
+                filter_entries(entries(), members=['libarchive/'])]
+    assert selected == ['libarchive/']
+    assert seen == ['libarchive/']
+
+
+@pytest.mark.parametrize('extract', [
+    extract_entries, extract_entries_pipelined
+])
+def test_extract_dest_rewrite(tmpdir, extract):
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    archive_path = tmpdir.strpath+'/test.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        tar.add('libarchive')
+        tar.add('README.rst')
+        link = tar.gettarinfo('README.rst', 'README.link')
+        link.type, link.linkname, link.size = tarfile.LNKTYPE, 'README.rst', 0
+        tar.addfile(link)
+
+    def rewrite(path):
+        if path == 'README.rst':
+            return 'README.txt'
+        if path.startswith('libarchive/__pycache__'):
+            return None
+        return path.replace('libarchive', 'renamed', 1)
+
+    flags = EXTRACT_OWNER | EXTRACT_PERM | EXTRACT_TIME
+    with libarchive.file_reader(archive_path) as archive:
+        extract(archive, flags, dest=tmpdir.strpath+'/dest',
+                rewrite_path=rewrite)
+    dest = tmpdir.join('dest')
+    assert sorted(p.basename for p in dest.listdir()) == [
+        'README.link', 'README.txt', 'renamed'
+    ]
+    assert dest.join('README.link').stat().ino == \
+        dest.join('README.txt').stat().ino
+    with in_dir(dest.strpath):
+        tree2 = treestat('renamed')
+        assert tree2 == dict(
+            (p.replace('libarchive', 'renamed', 1), s)
+            for p, s in tree.items()
+        )
+
+
+@pytest.mark.parametrize('extract', [
+    extract_entries, extract_entries_pipelined
+])
+def test_extract_dest_confined(tmpdir, extract):
+    archive_path = tmpdir.strpath+'/test.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        for name in ('/abs.txt', 'rel.txt'):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b'abc'))
+
+    # the paths are absolute once dest is applied, that's fine
+    dest = tmpdir.mkdir('dest')
+    with libarchive.file_reader(archive_path) as archive:
+        extract(archive, dest=dest.strpath)
+    assert sorted(p.basename for p in dest.listdir()) == ['abs.txt', 'rel.txt']
+    with libarchive.file_reader(archive_path) as archive:
+        with pytest.raises(libarchive.ArchiveError):
+            extract(archive, EXTRACT_SECURE_NOABSOLUTEPATHS,
+                    dest=tmpdir.mkdir('dest2').strpath)
+    with libarchive.file_reader(archive_path) as archive:
+        extract(archive, EXTRACT_SECURE_NOABSOLUTEPATHS,
+                dest=tmpdir.mkdir('dest3').strpath,
+                rewrite_path=lambda path: path.lstrip('/'))
+
+    # entries can't escape from dest
+    with tarfile.open(archive_path, 'w') as tar:
+        info = tarfile.TarInfo('../escaped.txt')
+        info.size = 3
+        tar.addfile(info, io.BytesIO(b'abc'))
+    with libarchive.file_reader(archive_path) as archive:
+        with pytest.raises(libarchive.ArchiveError):
+            extract(archive, dest=tmpdir.mkdir('dest4').strpath)
+    assert not tmpdir.join('escaped.txt').exists()
+
+
+@pytest.mark.parametrize('arena_size', [None, 1000000])
+def test_extract_to_memory(arena_size):
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar', 'gzip') as archive:
+        archive.add_files('libarchive/', 'README.rst')
+
+    with libarchive.memory_reader(buf) as archive:
+        files = libarchive.extract_to_memory(archive, arena_size,
+                                             include='*.py')
+    expected = {}
+    for name in os.listdir('libarchive'):
+        if name.endswith('.py'):
+            with open('libarchive/' + name, 'rb') as f:
+                expected['libarchive/' + name] = f.read()
+    assert files == expected
+
+
+def test_extract_to_memory_arena_too_small():
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar') as archive:
+        archive.add_files('README.rst')
+
+    with libarchive.memory_reader(buf) as archive:
+        with pytest.raises(libarchive.ArchiveError):
+            libarchive.extract_to_memory(archive, 10)
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(block_size=100),
+    dict(mmap_threshold=0),
+    dict(block_size=100, mmap_threshold=2000),
+])
+def test_add_files_options(kwargs):
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar', 'gzip') as archive:
+        archive.add_files('libarchive/', **kwargs)
+
+    with libarchive.memory_reader(buf) as archive:
+        check_archive(archive, tree)
+
+
+def test_add_files_mmap_failure():
+    # a file that can't be mapped must not leave a truncated entry behind
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar') as archive:
+        with patch('libarchive.ffi.libc_mmap', return_value=None):
+            with pytest.raises(OSError):
+                archive.add_files('README.rst', mmap_threshold=0)
+        archive.add_files('setup.py', mmap_threshold=0)
+
+    with libarchive.memory_reader(buf) as archive:
+        entries = [(entry.pathname, b''.join(entry.get_blocks()))
+                   for entry in archive]
+    with open('setup.py', 'rb') as f:
+        assert entries == [('setup.py', f.read())]
+
+
+def test_add_files_bad_option():
+    buf = bytes(bytearray(1000))
+    with pytest.raises(TypeError):
+        with libarchive.memory_writer(buf, 'gnutar') as archive:
+            archive.add_files('README.rst', blocksize=100)
+
+
+@pytest.mark.parametrize('filter_name', ['gzip', 'bzip2', 'xz'])
+def test_parallel_writer(tmpdir, filter_name):
+    # Collect information on what should be in the archive
+    tree = treestat('libarchive')
+
+    path = str(tmpdir / 'test.tar')
+    with libarchive.parallel_file_writer(
+        path, 'gnutar', filter_name, workers=3, chunk_size=10000,
+    ) as archive:
+        archive.add_files('libarchive/')
+
+    if filter_name != 'bzip2':
+        # every chunk is a separate frame
+        from libarchive.checkpoint import scan_checkpoints
+        with open(path, 'rb') as f:
+            assert len(scan_checkpoints(f)) > 1
+
+    with libarchive.file_reader(path) as archive:
+        check_archive(archive, tree)
+
+
+def test_parallel_writer_bad_filter():
+    with pytest.raises(ValueError):
+        with libarchive.parallel_writer(list().append, 'gnutar', 'lz4'):
+            pass
+
+
+def test_write_options():
+    tree = treestat('libarchive')
+
+    stored = bytes(bytearray(1000000))
+    with libarchive.memory_writer(
+        stored, 'zip', options='zip:compression=store'
+    ) as archive:
+        archive.add_files('libarchive/')
+    deflated = bytes(bytearray(1000000))
+    with libarchive.memory_writer(
+        deflated, 'zip', options='zip:compression=deflate'
+    ) as archive:
+        archive.add_files('libarchive/')
+    assert stored.rstrip(b'\0') != deflated.rstrip(b'\0')
+    assert len(stored.rstrip(b'\0')) > len(deflated.rstrip(b'\0'))
+
+    for buf in (stored, deflated):
+        with libarchive.memory_reader(buf) as archive:
+            check_archive(archive, tree)
+
+
+@pytest.mark.parametrize('filter_name, options', [
+    ('gzip', 'gzip:compression-level=1'),
+    ('xz', 'xz:threads=2'),
+    ('zstd', 'zstd:compression-level=3'),
+])
+def test_write_filter_options(tmpdir, filter_name, options):
+    if filter_name not in libarchive.ffi.WRITE_FILTERS:
+        pytest.skip('%s is not supported by libarchive' % filter_name)
+    tree = treestat('libarchive')
+
+    path = str(tmpdir / 'test.tar')
+    with libarchive.file_writer(
+        path, 'gnutar', filter_name, options=options
+    ) as archive:
+        archive.add_files('libarchive/')
+
+    with libarchive.file_reader(path, options='read_concatenated_archives') \
+            as archive:
+        check_archive(archive, tree)
+
+
+def test_bad_options():
+    buf = bytes(bytearray(1000))
+    with pytest.raises(libarchive.ArchiveError):
+        with libarchive.memory_writer(buf, 'gnutar', options='foo=bar'):
+            pass
+    with pytest.raises(libarchive.ArchiveError):
+        with libarchive.memory_reader(buf, options='foo=bar'):
+            pass
+
+
+def test_zip_compression_option(tmpdir):
+    data_dir = tmpdir.mkdir('data')
+    data_dir.join('a.txt').write(b'a' * 100000, 'wb')
+    data_dir.join('b.jpg').write(b'b' * 300000, 'wb')
+    data_dir.join('c.bin').write(os.urandom(200000), 'wb')
+    paths = [str(data_dir)]
+
+    assert zip_compression_option(paths) == 'zip:compression=store'
+    assert zip_compression_option(paths, min_fraction=0.7) == \
+        'zip:compression=deflate'
+    policy = store_if_incompressible()
+    assert zip_compression_option(paths, policy) == 'zip:compression=deflate'
+    assert zip_compression_option(paths, policy, min_fraction=0.3) == \
+        'zip:compression=store'
+    assert zip_compression_option([]) == 'zip:compression=deflate'
+
+    # the files are only read by the policies that need it
+    with patch('libarchive.write.read_sample') as read_sample:
+        zip_compression_option(paths)
+    assert not read_sample.called
+
+    path = str(tmpdir / 'test.zip')
+    options = zip_compression_option(paths)
+    with libarchive.file_writer(path, 'zip', options=options) as archive:
+        archive.add_files(*paths)
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            if not info.is_dir():
+                assert info.compress_type == zipfile.ZIP_STORED
+        name = [n for n in z.namelist() if n.endswith('c.bin')][0]
+        assert z.read(name) == data_dir.join('c.bin').read('rb')
+
+
+def test_stream_archive(tmpdir):
+    big = tmpdir.join('big')
+    big.write(os.urandom(1000000), 'wb')
+    big_path = str(big)
+
+    chunks = []
+    for chunk in libarchive.stream_archive(
+        ['libarchive/', big_path], 'gnutar', 'gzip', chunk_size=10000,
+    ):
+        # the size of the chunks is bounded even for a big entry
+        assert len(chunk) <= 10000
+        chunks.append(chunk)
+    assert len(chunks) > 100
+
+    with libarchive.memory_reader(b''.join(chunks)) as archive:
+        contents = {}
+        for entry in archive:
+            contents[entry.pathname] = b''.join(entry.get_blocks())
+    assert 'libarchive/write.py' in contents
+    assert contents[big_path.lstrip('/')] == big.read('rb')
+
+
+def test_stream_archive_entries():
+    buf = bytes(bytearray(1000000))
+    with libarchive.memory_writer(buf, 'gnutar') as archive:
+        archive.add_files('libarchive/')
+    tree = treestat('libarchive')
+
+    with libarchive.memory_reader(buf) as archive:
+        data = b''.join(libarchive.stream_archive(archive, 'zip'))
+    with libarchive.memory_reader(data) as archive:
+        check_archive(archive, tree)
+
+    # abandoning the stream doesn't leak or crash
+    chunks = libarchive.stream_archive(['libarchive/'], 'zip',
+                                       chunk_size=512)
+    next(chunks)
+    chunks.close()
+
+
+def crashing_extract_file(path, *args):
+    if path.endswith('crash'):
+        os._exit(1)
+    return extract_file(path, *args)
+
+
+def test_extract_many_broken_pool(tmpdir):
+    from concurrent.futures.process import BrokenProcessPool
+
+    tree = treestat('libarchive')
+
+    paths, dest_dirs = [], []
+    for name in ('a', 'crash', 'b'):
+        path = tmpdir.strpath+'/' + name
+        with libarchive.file_writer(path, 'ustar') as archive:
+            archive.add_files('libarchive/')
+        paths.append(path)
+        dest_dirs.append(tmpdir.mkdir('dest_' + name).strpath)
+
+    with patch('libarchive.extract.extract_file', crashing_extract_file):
+        results = libarchive.extract_many(
+            paths, dest_dirs, EXTRACT_OWNER | EXTRACT_PERM | EXTRACT_TIME,
+            workers=1, max_pending=1,
+        )
+    assert [r.path for r in results] == paths
+    assert isinstance(results[1].error, BrokenProcessPool)
+    for result in (results[0], results[2]):
+        assert result.error is None
+        with in_dir(result.dest_dir):
+            assert treestat('libarchive') == tree